@@ -28,8 +28,10 @@
 set REGIONS; # regions
 set RWITHOUTDAM within REGIONS; # regions that don't have hydro dams
 
-set PERIODS := 1 .. 8760; # time periods (hours of the year)
-set HOURS := 1 .. 24; # hours of the day
+param period_duration integer > 0, <= 24 default 1; # [h] number of hours in each time period (1 for an hourly resolution)
+check: 24 mod period_duration == 0;
+set PERIODS := 1 .. 8760 div period_duration; # time periods (hours of the year)
+set HOURS := 1 .. 24 div period_duration; # hours of the day (periods of the day if period_duration > 1)
 param nbr_tds > 0;  # number of typical days
 set TYPICAL_DAYS := 1 .. nbr_tds ordered; # typical days
 set T_H_TD within {PERIODS, HOURS, TYPICAL_DAYS}; # set linking periods, hours, days, typical days
@@ -82,7 +84,7 @@ set NETWORK_TYPE {EXCHANGE_NETWORK_R} within TECHNOLOGIES; # different types of
 ## Parameters added to define scenarios and technologies [Table 2]
 param i_rate > 0; # discount rate [-]: real discount rate
 param gwp_limit_overall >=0; # [ktCO2-eq./year] maximum gwp emissions allowed for global system
-param t_op {HOURS, TYPICAL_DAYS} default 1;# [h]: operating time 
+param t_op {HOURS, TYPICAL_DAYS} default period_duration;# [h]: operating time 
 
 # Attributes of TECHNOLOGIES and RESOURCES
 param c_op_exterior {RESOURCES} >= 0; 
@@ -355,7 +357,7 @@ subject to resource_availability_exterior {c in REGIONS, i in RESOURCES}:
 	
 # [Eq. 2.12-bis] Constant flow of import for resources listed in SET RES_IMPORT_CONSTANT
 subject to resource_constant_import {c in REGIONS, i in RES_IMPORT_CONSTANT, h in HOURS, td in TYPICAL_DAYS}:
-	R_t_exterior [c, i, h, td] * t_op [h, td] = Import_constant [c, i];
+	R_t_exterior [c, i, h, td] = Import_constant [c, i];
 
 ## Layers
 #--------
@@ -376,11 +378,11 @@ subject to layer_balance {c in REGIONS, l in LAYERS, h in HOURS, td in TYPICAL_D
 # [Eq. 14] The level of the storage represents the amount of energy stored at a certain time.
 subject to storage_level {c in REGIONS, j in STORAGE_TECH, t in PERIODS, h in HOUR_OF_PERIOD[t], td in TYPICAL_DAY_OF_PERIOD[t]}:
 	Storage_level [c, j, t] = (if t == 1 then
-	 			Storage_level [c, j, card(PERIODS)] * (1.0 -  storage_losses[j])
+	 			Storage_level [c, j, card(PERIODS)] * (1.0 -  storage_losses[j]) ^ period_duration
 				+ t_op [h, td] * (   (sum {l in LAYERS: storage_eff_in [j,l] > 0}  (Storage_in [c, j, l, h, td]  * storage_eff_in  [j, l])) 
 				                   - (sum {l in LAYERS: storage_eff_out [j,l] > 0} (Storage_out [c, j, l, h, td] / storage_eff_out [j, l])))
 	else
-	 			Storage_level [c, j, t-1] * (1.0 -  storage_losses[j])
+	 			Storage_level [c, j, t-1] * (1.0 -  storage_losses[j]) ^ period_duration
 				+ t_op [h, td] * (   (sum {l in LAYERS: storage_eff_in [j,l] > 0}  (Storage_in [c, j, l, h, td]  * storage_eff_in  [j, l])) 
 				                   - (sum {l in LAYERS: storage_eff_out [j,l] > 0} (Storage_out [c, j, l, h, td] / storage_eff_out [j, l])))
 				);
@@ -656,7 +658,7 @@ subject to f_min_perc {c in REGIONS, eut in END_USES_TYPES, j in TECHNOLOGIES_OF
 	
 # [Eq. ..] Limit electricity import capacity
 subject to max_elec_import {c in REGIONS, h in HOURS, td in TYPICAL_DAYS}:
-	R_t_exterior [c,"ELECTRICITY", h, td] * t_op [h, td] <= import_capacity[c]; 
+	R_t_exterior [c,"ELECTRICITY", h, td] <= import_capacity[c]; 
 
 
 
@@ -8,6 +8,7 @@ on the time series and the energy system results
 
 import json
 import math
+import warnings
 import pandas as pd
 import numpy as np
 from sklearn.linear_model import LinearRegression
@@ -74,12 +75,16 @@ def compute_dc(ts):
     return dc
 
 
-def read_kmedoid_tds(tds, my_model):
-    """Read the kmedoid results for each td"""
+def read_kmedoid_tds(tds, my_model, dat_dir=None):
+    """Read the kmedoid results for each td
+
+    The results can be generated for all tds at once with my_model.ta.sweep(nbr_tds=tds),
+    in that case, give dat_dir=my_model.dat_dir"""
     # read td_of_days
     td_of_days = pd.DataFrame(np.nan, index=np.arange(1, 366, 1), columns=tds)
     e_ts_kmedoid = pd.Series(np.nan, index=tds)
-    dat_dir = my_model.dat_dir/'td_dat'
+    if dat_dir is None:
+        dat_dir = my_model.dat_dir/'td_dat'
 
     for t in tds:
         step1_out = dat_dir/('TD_of_days_'+str(t)+'.out')
@@ -95,26 +100,67 @@ def read_kmedoid_tds(tds, my_model):
 def compute_ts_from_td(td_of_days, ts):
     """Compute the synthetic time series from typical days
 
-    TO BE IMPROVED... too slow -> use the same methods as for ts_td in regions and from_td_to_year in temporal_aggregation"""
-    ts_from_td = ts.copy()
-    for day in range(365):
-        td = td_of_days.loc[day + 1]
-        ts_from_td.loc[day * 24 + 1:(day + 1) * 24, :] = ts.loc[(td - 1) * 24 + 1:td * 24, :].set_index(
-            pd.Index(np.arange(day * 24 + 1, (day + 1) * 24 + 1)))
-    # scaling the ts from td to keep the total amount over the year
-    ts_from_td = ts_from_td * ts.sum() / ts_from_td.sum()
+    Parameters
+    ----------
+    td_of_days: pd.Series
+        Typical day representing each day of the year (index from 1 to 365)
+    ts: pd.DataFrame
+        Time series of the year (8760 x n_series)
+
+    Returns
+    -------
+    ts_from_td: pd.DataFrame
+        Synthetic time series (same shape as ts) rescaled to keep the total amount over the year
+
+    """
+    ts_from_td = ts_from_td_batch(td_of_days.to_numpy().reshape(-1, 1), ts.to_numpy(dtype=np.float64))[0]
+    return pd.DataFrame(ts_from_td, index=ts.index, columns=ts.columns)
+
+
+def ts_from_td_batch(td_of_days, ts):
+    """Compute the synthetic time series of several typical days configurations at once
+
+    The day/hour gather is done with one NumPy fancy-index on the (8760 x n_series) array
+
+    Parameters
+    ----------
+    td_of_days: np.ndarray
+        Typical day representing each day of the year (365 x n_config), days numbered from 1 to 365
+    ts: np.ndarray
+        Time series of the year (8760 x n_series)
+
+    Returns
+    -------
+    ts_from_td: np.ndarray
+        Synthetic time series of each configuration (n_config x 8760 x n_series),
+        rescaled to keep the total amount over the year (NaN if the total of the synthetic time series is null)
 
+    """
+    td_of_days = np.asarray(td_of_days, dtype=int)
+    # hour of the year (from 0) of the original time series used for each hour of the synthetic year
+    hours = np.repeat((td_of_days.T - 1) * 24, 24, axis=1) + np.tile(np.arange(24), td_of_days.shape[0])
+    ts_from_td = ts[hours]
+    # scaling the ts from td to keep the total amount over the year
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ts_from_td *= (ts.sum(axis=0) / ts_from_td.sum(axis=1))[:, None, :]
     return ts_from_td
 
 
+def dc_batch(ts):
+    """Compute the duration curves of an array of time series along the hours axis (axis=-2), NaN are put last"""
+    return -np.sort(-ts, axis=-2)
+
+
 def compute_all_ts_from_td(tds, td_of_days, all_ts):
     """Compute synthetic ts and dc from"""
     all_ts_from_td = dict()
     all_dc_from_td = dict()
 
-    for t in tds:
-        all_ts_from_td[t] = compute_ts_from_td(td_of_days.loc[:, t], all_ts)
-        all_dc_from_td[t] = compute_dc(all_ts_from_td[t])
+    ts_from_td = ts_from_td_batch(td_of_days.loc[:, tds].to_numpy(), all_ts.to_numpy(dtype=np.float64))
+    dc_from_td = dc_batch(ts_from_td)
+    for i, t in enumerate(tds):
+        all_ts_from_td[t] = pd.DataFrame(ts_from_td[i], index=all_ts.index, columns=all_ts.columns)
+        all_dc_from_td[t] = pd.DataFrame(dc_from_td[i], columns=all_ts.columns)
 
     return all_ts_from_td, all_dc_from_td
 
@@ -124,34 +170,95 @@ def abs_err(df1, df2):
     return ((df1-df2).abs()).sum()
 
 
-def abs_err_corr(all_ts, all_ts_from_td, w, regions_names):
+def corr_batch(ts):
+    """Compute the Pearson correlation matrices of batches of time series
+
+    Parameters
+    ----------
+    ts: np.ndarray
+        Time series of shape (n_config x n_hours x n_series) or (n_hours x n_series)
+
+    Returns
+    -------
+    corr: np.ndarray
+        Correlation matrices of shape (n_config x n_series x n_series) or (n_series x n_series),
+        NaN for the time series with a null variance (as pandas.DataFrame.corr)
+
+    """
+    # centred and normalized time series
+    # (the time series full of NaN and the ones with a null variance give NaN without warning)
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        z = ts - np.nanmean(ts, axis=-2, keepdims=True)
+        z = z / np.sqrt((z ** 2).sum(axis=-2, keepdims=True))
+    return np.einsum('...ti,...tj->...ij', z, z, optimize=True)
+
+
+def abs_err_corr_batch(corr, corr_from_td, w, groups):
+    """Weighted absolute correlation error kernel
+
+    Parameters
+    ----------
+    corr: np.ndarray
+        Correlation matrix of the original time series (n_series x n_series)
+    corr_from_td: np.ndarray
+        Correlation matrices of the synthetic time series (n_config x n_series x n_series)
+    w: np.ndarray
+        Weight of each time series (n_series,), NaN weights are ignored
+    groups: np.ndarray
+        Boolean matrix (n_groups x n_series) defining which time series belong to each group
+
+    Returns
+    -------
+    e_corr: np.ndarray
+        Correlation error of each group (intra-group correlations only) and of all time series
+        (last column), shape (n_config x (n_groups+1))
+
     """
+    e = np.abs(corr[None, :, :] - corr_from_td) * (w[:, None] * w[None, :])
+    e = np.nan_to_num(e, nan=0.0)
+    groups = groups.astype(np.float64)
+    e_groups = np.einsum('gi,cij,gj->cg', groups, e, groups, optimize=True)
+    return np.concatenate([e_groups, e.sum(axis=(1, 2))[:, None]], axis=1)
 
 
+def abs_err_corr(all_ts, all_ts_from_td, w, regions_names):
+    """Compute the weighted correlation error between the original and the synthetic time series
+
     Parameters
     ----------
-    all_ts
-    all_ts_from_td
-    w
-    regions_names
+    all_ts: pd.DataFrame
+        Time series of all regions (8760 x (n_regions*n_series)), columns indexed by (Regions, Time series)
+    all_ts_from_td: pd.DataFrame
+        Synthetic time series (same shape as all_ts)
+    w: pd.Series
+        Normalized weight of each time series, indexed by (Regions, Time series)
+    regions_names: list
+        List of the regions names
 
     Returns
     -------
+    e_corr: pd.Series
+        Intra-regional correlation error of each region and overall correlation error ('ALL')
+
+    Notes
+    -----
+    The intra-regional errors differ from the ones of the previous pandas implementation on purpose:
+    its weights were not aligned with the correlation matrix, which gave an error of 0 for every region.
+    The overall error is unchanged.
 
     """
+    e_corr = abs_err_corr_batch(corr_batch(all_ts.to_numpy(dtype=np.float64)),
+                                corr_batch(all_ts_from_td.to_numpy(dtype=np.float64)[None, :, :]),
+                                w.reindex(all_ts.columns).to_numpy(dtype=np.float64),
+                                regions_groups(all_ts.columns, regions_names))
+    return pd.Series(e_corr[0], index=regions_names + ['ALL'])
+
 
-    # here shape of results
-    e_corr = pd.Series(np.nan, index=regions_names + ['ALL'])
-    # Intra-regional correlation error
-    for r in regions_names:
-        ts = all_ts.loc[:, (r, slice(None))]
-        ts_from_td = all_ts_from_td.loc[:, (r, slice(None))]
-        e_corr[r] = ((((ts.corr() - ts_from_td.corr()).abs())
-                      .mul(w.loc[(r, slice(None))], axis=0).mul(w.loc[(r, slice(None))], axis=1).sum().sum()))
-        # Overall correlation error
-    e_corr['ALL'] = (((all_ts.corr() - all_ts_from_td.corr()).abs())
-                     .mul(w, axis=0).mul(w, axis=1).sum().sum())
-    return e_corr
+def regions_groups(columns, regions_names):
+    """Boolean matrix (n_regions x n_columns) defining to which region each column belongs"""
+    regions = columns.get_level_values(0)
+    return np.array([regions == r for r in regions_names]).reshape(len(regions_names), len(columns))
 
 
 def compute_ts_errors(all_ts, all_dc, all_ts_from_td, all_dc_from_td, w, regions_names):
@@ -172,9 +279,11 @@ def compute_ts_errors(all_ts, all_dc, all_ts_from_td, all_dc_from_td, w, regions
         # Compute time series and duration curve errors for each number of tds and for each time series
         err_ts.loc[:, t] = abs_err(all_ts / tot_ts, all_ts_from_td[t] / tot_ts)
         err_dc.loc[:, t] = abs_err(all_dc / tot_ts, all_dc_from_td[t] / tot_ts)
-        # compute correlation error for each number of tds and all time series
-        error_corr.loc[:, t] = abs_err_corr(all_ts, all_ts_from_td[t], w, regions_names).rename(
-            lambda x: 'err_corr_' + x)
+    # compute correlation error for all numbers of tds and all time series
+    corr = corr_batch(all_ts.to_numpy(dtype=np.float64))
+    corr_from_td = corr_batch(np.stack([all_ts_from_td[t].to_numpy(dtype=np.float64) for t in tds]))
+    error_corr.loc[:, :] = abs_err_corr_batch(corr, corr_from_td, w.reindex(all_ts.columns).to_numpy(dtype=np.float64),
+                                              regions_groups(all_ts.columns, regions_names)).T
 
     # dataframe to summarise the errors
     all_error_ts = pd.DataFrame(np.nan, index=['err_ts', 'err_dc'] + corr_index, columns=tds)
@@ -187,21 +296,80 @@ def compute_ts_errors(all_ts, all_dc, all_ts_from_td, all_dc_from_td, w, regions
     return all_error_ts
 
 
+def compute_ts_errors_batch(all_ts, td_of_days, w, regions_names, max_size=2**25):
+    """Compute errors on time series (time series, duration curve and correlation)
+    for all the typical days configurations in td_of_days
+
+    Same results as compute_ts_errors but the synthetic time series and duration curves are computed
+    as NumPy arrays for batches of configurations (of at most max_size elements)
+    without building the intermediate dataframes
+
+    Parameters
+    ----------
+    all_ts: pd.DataFrame
+        Time series of all regions (8760 x (n_regions*n_series)), columns indexed by (Regions, Time series)
+    td_of_days: pd.DataFrame
+        Typical day representing each day of the year (index) for each number of typical days (columns)
+    w: pd.Series
+        Normalized weight of each time series, indexed by (Regions, Time series)
+    regions_names: list
+        List of the regions names
+    max_size: int
+        Maximum number of elements of the arrays of synthetic time series computed at once
+
+    Returns
+    -------
+    all_error_ts: pd.DataFrame
+        Errors (index) for each number of typical days (columns)
+
+    """
+    tds = list(td_of_days.columns)
+    ts = all_ts.to_numpy(dtype=np.float64)
+    corr_index = [('err_corr_' + r) for r in regions_names + ['ALL']]
+    err_ts = np.full((len(tds), ts.shape[1]), np.nan)
+    err_dc = np.full((len(tds), ts.shape[1]), np.nan)
+    error_corr = pd.DataFrame(np.nan, index=corr_index, columns=tds)
+
+    # correlation matrix of original time series, weights and regions
+    corr = corr_batch(ts)
+    w = w.reindex(all_ts.columns).to_numpy(dtype=np.float64)
+    groups = regions_groups(all_ts.columns, regions_names)
+
+    # normalized time series and duration curves
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_ts = ts / ts.sum(axis=0)
+        n_dc = dc_batch(n_ts)
+        batch = max(1, int(max_size // ts.size))
+        for b in range(0, len(tds), batch):
+            ts_from_td = ts_from_td_batch(td_of_days.iloc[:, b:b + batch].to_numpy(), ts)
+            n_ts_from_td = ts_from_td / ts.sum(axis=0)
+            # time series and duration curve errors for each number of tds and for each time series
+            err_ts[b:b + batch, :] = np.nansum(np.abs(n_ts[None, :, :] - n_ts_from_td), axis=1)
+            err_dc[b:b + batch, :] = np.nansum(np.abs(n_dc[None, :, :] - dc_batch(n_ts_from_td)), axis=1)
+            # correlation error for each number of tds and all time series
+            error_corr.iloc[:, b:b + batch] = abs_err_corr_batch(corr, corr_batch(ts_from_td), w, groups).T
+
+    # dataframe to summarise the errors
+    all_error_ts = pd.DataFrame(np.nan, index=['err_ts', 'err_dc'] + corr_index, columns=tds)
+    # pondered sum of time series
+    all_error_ts.loc['err_ts', :] = np.nansum(err_ts * w, axis=1)
+    all_error_ts.loc['err_dc', :] = np.nansum(err_dc * w, axis=1)
+    # add correlation errors in the dataframe
+    all_error_ts.loc[corr_index, :] = error_corr
+
+    return all_error_ts
+
+
 def a_priori_error(my_model, tds):
     """Computing a priori error"""
-    # group ts and compute duration curve
+    # group ts
     all_ts = group_ts(my_model)
-    # compute dc
-    all_dc = compute_dc(all_ts)
     # read kmedoid outputs
     td_of_days, e_ts_kmedoid = read_kmedoid_tds(tds, my_model)
-    # compute synthetic time series for each typical days configuration
-    # TODO TO BE IMPROVED... too slow
-    all_ts_from_td, all_dc_from_td = compute_all_ts_from_td(tds, td_of_days, all_ts)
-    # compute all errors
+    # compute all errors from the synthetic time series of each typical days configuration
     weights = my_model.ta.weights['Weights_n'].copy()
     weights.index.set_names(['Regions', 'Time series'], inplace=True)
-    all_ts_errors = compute_ts_errors(all_ts, all_dc, all_ts_from_td, all_dc_from_td, weights, my_model.regions_names)
+    all_ts_errors = compute_ts_errors_batch(all_ts, td_of_days, weights, my_model.regions_names)
 
     # drop regions correlation error
     all_ts_errors.drop(index=[('err_corr_' + r) for r in my_model.regions_names], inplace=True)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides NumPy implementations of the clustering algorithms
+used to select the typical days (TDs) in the TemporalAggregation class
+
+@author: Paolo Thiran
+"""
+import logging
+
+import numpy as np
+
+
+def l1_distance_matrix(x: np.ndarray, dtype=np.float32, max_block_size=2**24):
+    """Computes the L1 (manhattan) distance matrix between the rows of x
+
+    The computation is vectorized by blocks of rows such that the temporary array
+    of differences never exceeds max_block_size elements.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array of shape (n_days x n_dimensions) containing the data of each day
+    dtype : np.dtype, default: np.float32
+        Data type used for the computation and for the output
+    max_block_size : int, default: 2**24
+        Maximum number of elements of the temporary array of differences
+
+    Returns
+    -------
+    distance : np.ndarray
+        Symmetric array of shape (n_days x n_days) with the L1 distance between each pair of days
+
+    """
+    x = np.ascontiguousarray(x, dtype=dtype)
+    n, d = x.shape
+    distance = np.empty((n, n), dtype=dtype)
+    block = max(1, int(max_block_size // max(n * d, 1)))
+    for i in range(0, n, block):
+        distance[i:i + block, :] = np.abs(x[i:i + block, None, :] - x[None, :, :]).sum(axis=2, dtype=dtype)
+    return distance
+
+
+def reduce_dimensions(x: np.ndarray, method='pca', explained_variance=0.99, n_components=None, random_state=0):
+    """Projects the rows of x into a space of lower dimension
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Array of shape (n_days x n_dimensions) containing the data of each day
+    method : {'pca', 'random_projection'}, default: 'pca'
+        'pca': truncated principal component analysis (SVD of the centered data), keeping
+        the smallest number of components explaining at least explained_variance of the variance
+        'random_projection': sparse random projection (Li et al., 2006) on n_components dimensions
+    explained_variance : float, default: 0.99
+        Share of the variance to keep with the 'pca' method, not used if n_components is given
+    n_components : int, optional
+        Number of dimensions of the reduced space, default to 256 for the 'random_projection' method
+    random_state : int, default: 0
+        Seed of the random projection
+
+    Returns
+    -------
+    x_reduced : np.ndarray
+        Array of shape (n_days x n_components)
+
+    """
+    if method == 'pca':
+        from sklearn.decomposition import PCA
+        reducer = PCA(n_components=explained_variance if n_components is None else n_components,
+                      svd_solver='full')
+    elif method == 'random_projection':
+        from sklearn.random_projection import SparseRandomProjection
+        reducer = SparseRandomProjection(n_components=256 if n_components is None else n_components,
+                                         dense_output=True, random_state=random_state)
+    else:
+        raise ValueError('Unknown dimensionality reduction method ' + str(method))
+    return reducer.fit_transform(np.asarray(x, dtype=np.float64))
+
+
+def distance_distortion(x: np.ndarray, x_reduced: np.ndarray, n_pairs=10000, random_state=0):
+    """Measures the distortion of the L1 distances between days due to a dimensionality reduction
+
+    The L1 distances of randomly sampled pairs of days are computed in both spaces.
+    As a uniform scaling of the distances does not change the clustering, the distances in the reduced space
+    are first rescaled by the least-square factor before computing their relative error.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Original data, shape (n_days x n_dimensions)
+    x_reduced : np.ndarray
+        Reduced data, shape (n_days x n_components)
+    n_pairs : int, default: 10000
+        Number of sampled pairs of days
+    random_state : int, default: 0
+        Seed of the sampling
+
+    Returns
+    -------
+    distortion : dict
+        Mean and maximum relative errors ('mean', 'max') on the sampled distances and scaling factor ('scale')
+
+    """
+    rng = np.random.default_rng(random_state)
+    n = x.shape[0]
+    i = rng.integers(0, n, size=n_pairs)
+    j = rng.integers(0, n, size=n_pairs)
+    keep = i != j
+    i, j = i[keep], j[keep]
+    d = np.abs(x[i, :] - x[j, :]).sum(axis=1)
+    d_reduced = np.abs(x_reduced[i, :] - x_reduced[j, :]).sum(axis=1)
+    keep = d > 0
+    d, d_reduced = d[keep], d_reduced[keep]
+    scale = (d * d_reduced).sum() / max((d_reduced ** 2).sum(), np.finfo(float).tiny)
+    rel_err = np.abs(scale * d_reduced - d) / d
+    return {'mean': float(rel_err.mean()), 'max': float(rel_err.max()), 'scale': float(scale)}
+
+
+def pam(distance: np.ndarray, k: int, init=None, max_iter=1000):
+    """Partitioning Around Medoids (PAM) k-medoids clustering
+
+    The medoids are initialized with the greedy BUILD step and improved with the SWAP step
+    until no swap between a medoid and a non-medoid decreases the total distance.
+    Each SWAP iteration evaluates all the (medoid, non-medoid) pairs at once (FasterPAM decomposition)
+    and applies the best one. Ties are broken by the smallest index, which makes the result deterministic.
+
+    Parameters
+    ----------
+    distance : np.ndarray
+        Symmetric distance matrix of shape (n x n)
+    k : int
+        Number of clusters
+    init : list or np.ndarray, optional
+        Indices of medoids to start from (e.g. medoids of a previous clustering).
+        If less than k medoids are given, the missing ones are added with the BUILD step.
+    max_iter : int, default: 1000
+        Maximum number of SWAP iterations
+
+    Returns
+    -------
+    medoids : np.ndarray
+        Sorted indices of the k medoids
+    labels : np.ndarray
+        Index of the medoid assigned to each element, shape (n,)
+    cost : float
+        Sum of the distances between each element and its medoid
+
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    n = distance.shape[0]
+    if not 1 <= k <= n:
+        raise ValueError('The number of clusters k=' + str(k) + ' should be between 1 and ' + str(n))
+
+    # BUILD: greedily add the element decreasing the most the total distance
+    medoids = [] if init is None else list(dict.fromkeys(int(m) for m in init))[:k]
+    if len(medoids) == 0:
+        medoids.append(int(np.argmin(distance.sum(axis=1))))
+    d1 = distance[medoids, :].min(axis=0)
+    while len(medoids) < k:
+        gain = np.maximum(d1[None, :] - distance, 0).sum(axis=1)
+        gain[medoids] = -1
+        m = int(np.argmax(gain))
+        medoids.append(m)
+        d1 = np.minimum(d1, distance[m, :])
+
+    medoids = np.array(medoids)
+    # SWAP: apply the best swap as long as it decreases the total distance
+    for it in range(max_iter):
+        d_med = distance[medoids, :]
+        order = np.argsort(d_med, axis=0, kind='stable')
+        nearest = order[0, :]
+        d1 = d_med[nearest, np.arange(n)]
+        d2 = d_med[order[1, :], np.arange(n)] if k > 1 else np.full(n, np.inf)
+        # change of cost for the elements not assigned to the removed medoid
+        delta_d1 = distance - d1[None, :]
+        base = np.minimum(delta_d1, 0).sum(axis=1)
+        # correction for the elements assigned to the removed medoid
+        corr = np.minimum(distance, d2[None, :]) - d1[None, :] - np.minimum(delta_d1, 0)
+        delta = base[:, None] + corr @ np.eye(k)[nearest]
+        delta[medoids, :] = 0
+        x, i = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[x, i] >= -1e-12 * max(d1.sum(), 1):
+            break
+        medoids[i] = x
+    else:
+        logging.warning('PAM reached max_iter=' + str(max_iter) + ' without convergence')
+
+    medoids = np.sort(medoids)
+    d_med = distance[medoids, :]
+    labels = medoids[np.argmin(d_med, axis=0)]
+    # a medoid always represents itself
+    labels[medoids] = medoids
+    cost = float(distance[labels, np.arange(n)].sum())
+    return medoids, labels, cost
+
+
+def linkage(distance: np.ndarray, method='ward', x=None):
+    """Agglomerative hierarchical clustering
+
+    Builds the full dendrogram by merging at each step the 2 closest clusters.
+    Two linkages are available:
+    - 'ward': minimum increase of the within-cluster sum of squares (euclidean distances on x),
+      computed with the Lance-Williams update formula
+    - 'medoid_linkage': the distance between 2 clusters is the distance (from the distance matrix)
+      between their medoids
+
+    Parameters
+    ----------
+    distance : np.ndarray
+        Symmetric distance matrix of shape (n x n), used for the medoid linkage
+    method : {'ward', 'medoid_linkage'}, default: 'ward'
+        Linkage method
+    x : np.ndarray
+        Array of shape (n x n_dimensions) of the data to cluster, required for the ward linkage
+
+    Returns
+    -------
+    z : np.ndarray
+        Linkage matrix of shape (n-1 x 4) with the same convention as scipy.cluster.hierarchy.linkage:
+        at step i, clusters z[i, 0] and z[i, 1] are merged into cluster n+i, at a distance z[i, 2],
+        z[i, 3] being the number of elements in the new cluster
+
+    """
+    n = distance.shape[0]
+    if method == 'ward':
+        if x is None:
+            raise ValueError('x should be given for the ward linkage')
+        x = np.asarray(x, dtype=np.float64)
+        sq = (x ** 2).sum(axis=1)
+        d = np.maximum(sq[:, None] + sq[None, :] - 2 * x @ x.T, 0)
+    elif method == 'medoid_linkage':
+        distance = np.asarray(distance, dtype=np.float64)
+        d = distance.copy()
+        medoid = np.arange(n)
+        members = [[i] for i in range(n)]
+    else:
+        raise ValueError('Unknown linkage method ' + str(method))
+
+    np.fill_diagonal(d, np.inf)
+    size = np.ones(n)
+    cluster_id = np.arange(n)
+    active = np.ones(n, dtype=bool)
+    z = np.zeros((n - 1, 4))
+    for step in range(n - 1):
+        # find the closest pair of active clusters (i<j)
+        i, j = np.unravel_index(np.argmin(d), d.shape)
+        i, j = min(i, j), max(i, j)
+        d_ij = d[i, j]
+        z[step, :] = [cluster_id[i], cluster_id[j], np.sqrt(d_ij) if method == 'ward' else d_ij,
+                      size[i] + size[j]]
+
+        # merge j into i and update the distances to the new cluster
+        if method == 'ward':
+            n_k = size
+            new = ((size[i] + n_k) * d[i, :] + (size[j] + n_k) * d[j, :] - n_k * d_ij) \
+                / (size[i] + size[j] + n_k)
+        else:
+            members[i] = members[i] + members[j]
+            m = np.array(members[i])
+            medoid[i] = m[np.argmin(distance[np.ix_(m, m)].sum(axis=1))]
+            new = distance[medoid[i], medoid]
+        active[j] = False
+        size[i] = size[i] + size[j]
+        cluster_id[i] = n + step
+        new[~active] = np.inf
+        new[i] = np.inf
+        d[i, :] = new
+        d[:, i] = new
+        d[j, :] = np.inf
+        d[:, j] = np.inf
+
+    return z
+
+
+def cut_linkage(z: np.ndarray, k: int):
+    """Cuts the dendrogram defined by the linkage matrix z to get k clusters
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Linkage matrix (see linkage)
+    k : int
+        Number of clusters
+
+    Returns
+    -------
+    labels : np.ndarray
+        Cluster of each element, numbered from 0 to k-1 in order of first appearance
+
+    """
+    n = z.shape[0] + 1
+    if not 1 <= k <= n:
+        raise ValueError('The number of clusters k=' + str(k) + ' should be between 1 and ' + str(n))
+    # replay the n-k first merges
+    parent = np.arange(2 * n - 1)
+    for step in range(n - k):
+        parent[int(z[step, 0])] = n + step
+        parent[int(z[step, 1])] = n + step
+    root = np.arange(n)
+    for step in range(n - k):
+        root = parent[root]
+    _, labels = np.unique(root, return_inverse=True)
+    # renumber in order of first appearance
+    _, first = np.unique(labels, return_index=True)
+    rank = np.empty(k, dtype=int)
+    rank[np.argsort(first)] = np.arange(k)
+    return rank[labels]
+
+
+def medoids_of_clusters(distance: np.ndarray, labels: np.ndarray):
+    """Computes the medoid of each cluster
+
+    Parameters
+    ----------
+    distance : np.ndarray
+        Symmetric distance matrix of shape (n x n)
+    labels : np.ndarray
+        Cluster of each element, shape (n,)
+
+    Returns
+    -------
+    medoid_of_element : np.ndarray
+        Index of the medoid representing each element, shape (n,)
+    cost : float
+        Sum of the distances between each element and its medoid
+
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    medoid_of_element = np.zeros(labels.shape[0], dtype=int)
+    for c in np.unique(labels):
+        m = np.flatnonzero(labels == c)
+        medoid_of_element[m] = m[np.argmin(distance[np.ix_(m, m)].sum(axis=1))]
+    cost = float(distance[medoid_of_element, np.arange(labels.shape[0])].sum())
+    return medoid_of_element, cost
@@ -8,8 +8,11 @@ Contains ...
 """
 import logging
 import pathlib
-from pathlib import Path
 import os
+import time
+import hashlib
+import shutil
+import uuid
 
 import numpy as np
 import pandas as pd
@@ -36,41 +39,312 @@ def ampl_syntax(df: pd.DataFrame, comment=''):
     return df2
 
 
+class DatWriter:
+    """Writes a .dat file through a single buffered file handle
+
+    DatWriter is a context manager exposing the printing functions of this module (print_header, print_set,
+    print_df, newline, end_table, print_param), without reopening the file at each call.
+
+    Parameters
+    ----------
+    out_path : pathlib.Path
+        Path to the file to print
+    mode : str
+        'w' to overwrite the file (default), 'a' to append to it
+    buffering : int
+        Size of the buffer of the file handle in bytes
+
+    Examples
+    --------
+    >>> with DatWriter(dat_file) as w:
+    ...     w.print_header(header_txt='File containing the sets')
+    ...     w.print_set(my_set=['BE', 'FR'], name='REGIONS')
+
+    """
+
+    def __init__(self, out_path: pathlib.Path, mode='w', buffering=2 ** 20):
+        self.out_path = out_path
+        self.mode = mode
+        self.buffering = buffering
+        self.file = None
+        self.writer = None
+
+    def __enter__(self):
+        self.file = open(self.out_path, mode=self.mode, newline='', buffering=self.buffering)
+        self.writer = csv.writer(self.file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+        self.file = None
+        self.writer = None
+
+    def print_header(self, header_file=None, header_txt=''):
+        """Prints the header of the file, copied from header_file or, if None, header_txt"""
+        if header_file is None:
+            self.file.write('# ' + header_txt)
+            self.file.write('\n')
+        else:
+            # printing signature of data file
+            with open(header_file, 'r') as header:
+                for line in header:
+                    self.file.write(line)
+
+    def print_set(self, my_set: list, name: str, comment=''):
+        self.writer.writerow(['set ' + name + ' := \t' + '\t'.join(my_set) + ';' + comment])
+
+    def print_df(self, df: pd.DataFrame, name='', header=True, index=True, end_table=True):
+        df.to_csv(self.file, sep='\t', header=header, index=index, index_label=name, quoting=csv.QUOTE_NONE)
+        if end_table:
+            self.end_table()
+
+    def print_tables(self, values: np.ndarray, names: list, index, columns):
+        """Prints several tables with the same labels at once
+
+        The output is the same as print_df(ampl_syntax(df), name=name, end_table=False) for each table,
+        but all the values are formatted in a single vectorized pass.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values of the tables, of shape (N_tables x N_rows x N_columns)
+        names : list
+            Name (index label) of each table, e.g. '["PV","BE",*,*] :'
+        index : list
+            Labels of the rows of the tables
+        columns : list
+            Labels of the columns of the tables
+
+        """
+        if len(names) == 0:
+            return
+        n_rows = values.shape[-2]
+        # the floats are formatted into strings as pandas.DataFrame.to_csv does
+        cells = values.reshape(-1, values.shape[-1]).astype(str).tolist()
+        header = '\t'.join([str(c) for c in columns[:-1]] + [str(columns[-1]) + ' := '])
+        index = [str(i) + '\t' for i in index]
+        lines = list()
+        for k, name in enumerate(names):
+            lines.append(name + '\t' + header)
+            lines.extend([i + '\t'.join(row) for i, row in zip(index, cells[k * n_rows:(k + 1) * n_rows])])
+        self.file.write('\n'.join(lines) + '\n')
+
+    def to_csv(self, df: pd.DataFrame, **kwargs):
+        """Prints df as it is, with the arguments of pandas.DataFrame.to_csv"""
+        df.to_csv(self.file, **kwargs)
+
+    def newline(self, comment=list()):
+        self.writer.writerow([''])
+        for l in comment:
+            self.writer.writerow([l])
+
+    def end_table(self, comment=''):
+        self.writer.writerow([';' + comment])
+
+    def print_param(self, param, name: str, comment=''):
+        if comment == '':
+            self.writer.writerow(['param ' + str(name) + ' := ' + str(param) + ';'])
+        else:
+            self.writer.writerow(['param ' + str(name) + ' := ' + str(param) + '; # ' + str(comment)])
+
+
+class DatStore:
+    """Content-addressed store of the .dat files shared by the case studies of a spatial case study
+
+    Each .dat file is printed once into store_dir as <stem>_<fingerprint>.dat, where the fingerprint is a hash of
+    the sources (tables, dicts, lists and scalars) from which it is printed. The .dat file of a case study is then
+    a hard link to (or, if not possible, a symbolic link to or a copy of) the file of the store.
+    Thus, the .dat files identical to the ones of a previous case study are neither printed nor stored again.
+    As they are shared, the .dat files of the case studies should not be modified in place.
+    The files of the store not linked anymore by any case study are removed by clean.
+
+    Parameters
+    ----------
+    store_dir : pathlib.Path
+        Path to the directory of the store (e.g. case_studies/<space_id>/00_dat_store)
+
+    Examples
+    --------
+    >>> store = DatStore(cs_dir.parent / '00_dat_store')
+    >>> def write(path):
+    ...     with DatWriter(path) as w:
+    ...         w.print_df(ampl_syntax(df), name='param : ')
+    >>> store.print_dat(cs_dir / 'reg_resources.dat', sources=[df], write=write)
+
+    """
+
+    def __init__(self, store_dir: pathlib.Path):
+        self.store_dir = store_dir
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(sources: list):
+        """Computes a hash of the content of the sources of a .dat file
+
+        Parameters
+        ----------
+        sources : list
+            Sources of the .dat file. Dataframes and series are hashed with their labels and dtypes,
+            arrays with their shape and dtype, dicts and lists recursively (in their order)
+            and other objects through their repr.
+
+        Returns
+        -------
+        fingerprint: str
+            Hexadecimal hash of the sources
+
+        """
+        h = hashlib.sha1()
+
+        def update(x):
+            if isinstance(x, pd.Series):
+                x = x.to_frame()
+            if isinstance(x, pd.DataFrame):
+                h.update(repr((type(x).__name__, list(x.columns), list(x.index.names),
+                               [str(d) for d in x.dtypes])).encode())
+                h.update(pd.util.hash_pandas_object(x, index=True).values.tobytes())
+            elif isinstance(x, np.ndarray):
+                h.update(repr(('ndarray', x.shape, str(x.dtype))).encode())
+                h.update(np.ascontiguousarray(x).tobytes())
+            elif isinstance(x, dict):
+                h.update(('dict' + str(len(x))).encode())
+                for k, v in x.items():
+                    update(k)
+                    update(v)
+            elif isinstance(x, (list, tuple)):
+                h.update((type(x).__name__ + str(len(x))).encode())
+                for v in x:
+                    update(v)
+            else:
+                h.update(repr(x).encode())
+
+        for s in sources:
+            update(s)
+        return h.hexdigest()[:16]
+
+    def print_dat(self, dat_file: pathlib.Path, sources: list, write):
+        """Gives dat_file from the store, printing it into the store only if its sources are new
+
+        Parameters
+        ----------
+        dat_file : pathlib.Path
+            Path to the .dat file of the case study
+        sources : list
+            Sources from which the .dat file is printed (see fingerprint)
+        write : callable
+            Function printing the .dat file into the path given as argument
+
+        Returns
+        -------
+        stored: bool
+            True if the file was already in the store (i.e. not printed)
+
+        """
+        stored_file = self.store_dir / (dat_file.stem + '_' + self.fingerprint(sources) + dat_file.suffix)
+        stored = stored_file.is_file()
+        if stored:
+            logging.info('Linking ' + str(dat_file) + ' to ' + str(stored_file))
+            try:
+                self.link(stored_file, dat_file)
+                return stored
+            except FileNotFoundError:
+                # removed by the clean of another process in the meantime
+                stored = False
+        # print into a temporary file, such that a partially printed file is never used
+        tmp_path = stored_file.with_name(stored_file.name + '.' + uuid.uuid4().hex + '.tmp')
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, stored_file)
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        self.link(stored_file, dat_file)
+        return stored
+
+    @staticmethod
+    def link(stored_file: pathlib.Path, dat_file: pathlib.Path):
+        """Links dat_file to stored_file, with a hard link, a symbolic link or a copy (first one possible)"""
+        if dat_file.is_symlink() or dat_file.exists():
+            dat_file.unlink()
+        try:
+            os.link(stored_file, dat_file)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            try:
+                os.symlink(stored_file, dat_file)
+            except OSError:
+                shutil.copyfile(stored_file, dat_file)
+
+    def clean(self, min_age=3600):
+        """Removes the files of the store not linked anymore by any case study
+
+        The .dat files of the case studies (the directories next to store_dir) are linked to the files of the store
+        (hard or symbolic links resolving to the same file). The files of the store that none of them resolves to
+        (e.g. the ones of a case study run again with other data, or deleted) are removed, as well as the
+        temporary files left by interrupted printings.
+        Only the files older than min_age are removed, such that the files just printed by another process
+        and not linked yet are kept.
+
+        Parameters
+        ----------
+        min_age : float
+            Minimum age in seconds (since their printing) of the files to remove
+
+        Returns
+        -------
+        removed: list
+            Names of the removed files
+
+        """
+        linked = set()
+        for d in self.store_dir.parent.iterdir():
+            if d.is_dir() and d != self.store_dir:
+                for f in d.glob('*.dat'):
+                    try:
+                        stat = f.stat()
+                    except OSError:
+                        continue  # broken symbolic link
+                    linked.add((stat.st_dev, stat.st_ino))
+        removed = list()
+        now = time.time()
+        for f in self.store_dir.iterdir():
+            try:
+                stat = f.stat()
+                if (stat.st_dev, stat.st_ino) not in linked and now - stat.st_mtime > min_age:
+                    f.unlink()
+                    removed.append(f.name)
+            except OSError:
+                continue  # removed by another process in the meantime
+        if removed:
+            logging.info('Removed ' + str(len(removed)) + ' files not linked anymore from ' + str(self.store_dir))
+        return removed
+
+
 def print_set(my_set: list, out_path: pathlib.Path, name: str, comment=''):
-    with open(out_path, mode='a', newline='') as file:
-        writer = csv.writer(file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['set ' + name + ' := \t' + '\t'.join(my_set) + ';' + comment])
+    with DatWriter(out_path, mode='a') as w:
+        w.print_set(my_set=my_set, name=name, comment=comment)
 
 
 def print_df(df: pd.DataFrame, out_path: pathlib.Path, name='', mode='a', header=True, index=True, end_table=True):
-    df.to_csv(out_path, sep='\t', mode=mode, header=header, index=index, index_label=name, quoting=csv.QUOTE_NONE)
-    if end_table:
-        with open(out_path, mode='a', newline='') as file:
-            writer = csv.writer(file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow([';'])
+    with DatWriter(out_path, mode=mode) as w:
+        w.print_df(df=df, name=name, header=header, index=index, end_table=end_table)
 
 
 def newline(out_path: pathlib.Path, comment=list()):
-    with open(out_path, mode='a', newline='') as file:
-        writer = csv.writer(file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow([''])
-        for l in comment:
-            writer.writerow([l])
+    with DatWriter(out_path, mode='a') as w:
+        w.newline(comment=comment)
 
-def end_table(out_path: pathlib.Path, comment=''):
-    with open(out_path, mode='a', newline='') as file:
-        writer = csv.writer(file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow([';'+comment])
 
+def end_table(out_path: pathlib.Path, comment=''):
+    with DatWriter(out_path, mode='a') as w:
+        w.end_table(comment=comment)
 
 
 def print_param(param, out_path: pathlib.Path, name: str, comment=''):
-    with open(out_path, mode='a', newline='') as file:
-        writer = csv.writer(file, delimiter=AMPL_SEPARATOR, quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-        if comment == '':
-            writer.writerow(['param ' + str(name) + ' := ' + str(param) + ';'])
-        else:
-            writer.writerow(['param ' + str(name) + ' := ' + str(param) + '; # ' + str(comment)])
+    with DatWriter(out_path, mode='a') as w:
+        w.print_param(param=param, name=name, comment=comment)
 
 
 def print_header(dat_file: pathlib.Path, header_file=None, header_txt=''):
@@ -92,14 +366,5 @@ def print_header(dat_file: pathlib.Path, header_file=None, header_txt=''):
     -------
 
     """
-
-    if header_file is None:
-        with open(dat_file, mode='w', newline='') as file :
-            file.write('# ' + header_txt)
-            file.write('\n')
-
-    else:
-        # printing signature of data file
-        with open(dat_file, mode='w', newline='') as file, open(header_file, 'r') as header:
-            for line in header:
-                file.write(line)
+    with DatWriter(dat_file, mode='w') as w:
+        w.print_header(header_file=header_file, header_txt=header_txt)
@@ -27,13 +27,11 @@
 ############################
 ###  MILP formulation    ###
 ############################
-set DIMENSIONS ; # := 1 .. 504;		# Number of input data per day (24h x nbr of time series)
 set DAYS := 1 .. 365;			# Number of days
 
 ### parameters
 param Nbr_TD default 12; 				#Number of TD days
-param Ndata{DAYS,DIMENSIONS}; 			#Input data (already normalized)
-param Distance{i in DAYS,j in DAYS} := sum{k in DIMENSIONS} abs(Ndata[i,k]-Ndata[j,k]) ; # Distance matrix.
+param Distance{i in DAYS,j in DAYS}; 	# Distance matrix (L1 distance between the normalized data of each day, computed in python)
 
 ### Variables
 var Selected_TD {DAYS} 				binary;# default 0; #which are the typical days
@@ -8,9 +8,16 @@ import logging
 import numpy as np
 import pandas as pd
 import csv
+import hashlib
+import json
+import os
+import shutil
+import uuid
 from pathlib import Path
 import esmc.preprocessing.dat_print as dp
+import esmc.preprocessing.clustering as cl
 from esmc.utils.opti_probl import OptiProbl
+from esmc.utils.region import Region
 
 class TemporalAggregation:
     """
@@ -31,6 +38,22 @@ class TemporalAggregation:
         normalized daily time series of all regions concatenated
     n_data : pd.DataFrame()
         normalized and weighted daily time series of all regions concatenated, used in the clustering algorithm
+    distance : np.ndarray
+        L1 distance matrix between the days of n_data (365x365), computed on demand by distance_matrix()
+    warm_start : bool
+        if True, the PAM clustering starts from the medoids of the previous clustering in dat_dir (if any)
+    compact : bool
+        if True, n_daily_ts and n_data are built as single contiguous float32 blocks (see group and weight)
+    period_duration : int
+        number of hours aggregated into each period of the typical days (1, 2, 3, 4, 6, 8, 12 or 24)
+    fingerprint : str
+        hash of the inputs of the clustering, naming its cache directory dat_dir/cache/<fingerprint>
+    reduction : str
+        dimensionality reduction applied to n_data ('pca', 'random_projection' or None)
+    distortion : dict
+        relative errors on the distances between days due to the dimensionality reduction (see weight)
+    tse : float
+        a priori time series error of the clustering, if the number of typical days was selected by search_nbr_td
 
     Methods
     -------
@@ -38,7 +61,9 @@ class TemporalAggregation:
         Prints the animals name and what sound it makes
     """
 
-    def __init__(self, regions, dat_dir:Path,  time_series_mapping: dict, Nbr_TD=10, algo='kmedoid', ampl_path=None):
+    def __init__(self, regions, dat_dir:Path,  time_series_mapping: dict, Nbr_TD=10, algo='kmedoid', ampl_path=None,
+                 target_tse=None, reduction=None, reduction_options=None, warm_start=False, use_cache=True,
+                 compact=False, period_duration=1):
 
         self.regions_names = list(regions.keys())
         self.time_series_mapping = time_series_mapping
@@ -49,31 +74,208 @@ class TemporalAggregation:
         self.regions = regions
         self.dat_dir = dat_dir
         self.dat_dir.mkdir(parents=True, exist_ok=True)
+        self.compact = compact
+        if 24 % period_duration != 0:
+            raise ValueError('period_duration should divide 24, got ' + str(period_duration))
+        self.period_duration = period_duration
         # pivot ts in each region to have (365x(24*N_ts))
-        self.pivot_ts()
+        # (in compact mode, the pivoting is done directly into the concatenated array by group)
+        if not self.compact:
+            self.pivot_ts()
 
         self.weights = pd.DataFrame()
         self.n_daily_ts = pd.DataFrame()
         # group and weight the time series of all the regions
         self.group()
         self.n_data = pd.DataFrame()
-        self.weight()
+        self.reduction = reduction
+        self.distortion = dict()
+        self.weight(reduction=reduction, **({} if reduction_options is None else reduction_options))
 
+        self.distance = None
+        self.warm_start = warm_start
         self.td_of_days = pd.DataFrame()
         self.e_ts = np.nan
-        # run clustering algorithm
-        if algo=='kmedoid':
-            self.td_of_days = self.kmedoid_clustering(ampl_path=ampl_path)
-        elif algo=='read':
-            self.td_of_days = self.read_td_of_days()
-            self.e_ts = pd.read_csv(dat_dir / ('e_ts' + str(self.Nbr_TD) + '.txt'),
-                                    header=None, index_col=None, sep='\t').values[0,0]
+        self.tse = np.nan
+        self.fingerprint = self.compute_fingerprint(algo=algo, target_tse=target_tse, reduction=reduction,
+                                                    reduction_options=reduction_options)
+        use_cache = use_cache and algo != 'read'
+        # reuse the result of an identical clustering, if any
+        if not (use_cache and self.read_cache()):
+            # run clustering algorithm
+            if target_tse is None:
+                self.td_of_days = self.run_clustering(algo=algo, ampl_path=ampl_path)
+            else:
+                # select the number of typical days to reach the target time series error
+                self.td_of_days = self.search_nbr_td(target_tse=target_tse, algo=algo, ampl_path=ampl_path)
+            if use_cache:
+                self.write_cache()
 
         logging.info('The typical days clustering has an time series error of ' + str(self.e_ts))
         self.t_h_td = pd.DataFrame()
         self.generate_t_h_td()
         return
 
+    def run_clustering(self, algo='kmedoid', ampl_path=None):
+        """Runs the clustering algorithm to select Nbr_TD typical days
+
+        Parameters
+        ----------
+        algo: {'kmedoid', 'pam', 'ward', 'medoid_linkage', 'read'}
+            Clustering algorithm, 'read' reads the results of a previous clustering
+        ampl_path: pathlib.Path
+            Path to ampl, only used by the 'kmedoid' algorithm
+
+        Returns
+        -------
+        td_of_days: pd.DataFrame()
+            Typical day (number of the day in the year) representing each day of the year
+
+        """
+        if algo=='kmedoid':
+            td_of_days = self.kmedoid_clustering(ampl_path=ampl_path)
+        elif algo=='pam':
+            td_of_days = self.pam_clustering()
+        elif algo in ['ward', 'medoid_linkage']:
+            td_of_days = self.hierarchical_clustering(method=algo)
+        elif algo=='read':
+            td_of_days = self.read_td_of_days()
+            self.e_ts = pd.read_csv(self.dat_dir / ('e_ts' + str(self.Nbr_TD) + '.txt'),
+                                    header=None, index_col=None, sep='\t').values[0,0]
+        else:
+            raise ValueError('Unknown clustering algorithm ' + str(algo))
+        return td_of_days
+
+    def search_nbr_td(self, target_tse: float, algo='pam', ampl_path=None, nbr_td_min=2, nbr_td_max=365):
+        """Selects the smallest number of typical days having an a priori time series error below target_tse
+
+        The number of typical days is first doubled from nbr_td_min until the target is met (galloping)
+        and then found by bisection. The time series error is the a priori error 'err_ts' of
+        esmc.postprocessing.td_analysis. The clusterings of the tested numbers of typical days are printed
+        into dat_dir, the distance matrix (or dendrogram) being computed only once for all of them.
+        The Nbr_TD, e_ts and tse attributes are set to the ones of the selected clustering.
+
+        Parameters
+        ----------
+        target_tse: float
+            Maximum a priori time series error
+        algo: {'pam', 'ward', 'medoid_linkage', 'kmedoid', 'read'}
+            Clustering algorithm
+        ampl_path: pathlib.Path
+            Path to ampl, only used by the 'kmedoid' algorithm
+        nbr_td_min, nbr_td_max: int
+            Bounds on the number of typical days
+
+        Returns
+        -------
+        td_of_days: pd.DataFrame()
+            Typical day representing each day of the year for the selected number of typical days
+
+        """
+        # imported here to avoid circular imports (td_analysis imports Esmc)
+        from esmc.postprocessing.td_analysis import compute_ts_errors_batch
+
+        logging.info('Searching the number of typical days to reach a time series error of ' + str(target_tse))
+        all_ts = pd.concat([self.regions[r].data['Time_series'] for r in self.regions_names], axis=1,
+                           keys=self.regions_names)
+        weights = self.weights['Weights_n']
+        results = dict()
+
+        def evaluate(k):
+            # cluster with k typical days and compute the a priori time series error
+            if k not in results:
+                self.Nbr_TD = k
+                td_of_days = self.run_clustering(algo=algo, ampl_path=ampl_path)
+                tse = compute_ts_errors_batch(all_ts, td_of_days.rename(columns={'TD_of_days': k}), weights,
+                                              self.regions_names).loc['err_ts', k]
+                results[k] = (td_of_days, self.e_ts, tse)
+                logging.info(str(k) + ' typical days: time series error of ' + str(tse))
+            return results[k][2] <= target_tse
+
+        # galloping search of an upper bound
+        lo, hi = None, nbr_td_min
+        while not evaluate(hi):
+            if hi >= nbr_td_max:
+                logging.warning('The target time series error ' + str(target_tse) + ' is not reached with '
+                                + str(nbr_td_max) + ' typical days')
+                break
+            lo, hi = hi, min(2 * hi, nbr_td_max)
+        # bisection between the last failing and the first succeeding numbers of typical days
+        if lo is not None and results[hi][2] <= target_tse:
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if evaluate(mid):
+                    hi = mid
+                else:
+                    lo = mid
+
+        self.Nbr_TD = hi
+        td_of_days, self.e_ts, self.tse = results[hi]
+        logging.info('Selected ' + str(hi) + ' typical days with a time series error of ' + str(self.tse))
+        return td_of_days
+
+    def compute_fingerprint(self, algo, target_tse=None, reduction=None, reduction_options=None):
+        """Computes a hash of all the inputs of the clustering
+
+        The fingerprint covers the regions, the content of their Time_series and Weights,
+        the normalized weights, the time_series_mapping, the number of typical days (or the target time series error),
+        the algorithm, the dimensionality reduction and the compact mode (float32 data giving possibly other medoids).
+
+        Returns
+        -------
+        fingerprint: str
+            Hexadecimal hash of the inputs of the clustering
+
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps({'regions': self.regions_names, 'time_series_mapping': self.time_series_mapping,
+                             'Nbr_TD': self.Nbr_TD if target_tse is None else None, 'target_tse': target_tse,
+                             'algo': algo, 'reduction': reduction, 'reduction_options': reduction_options,
+                             'compact': self.compact},
+                            sort_keys=True, default=str).encode())
+        for r in self.regions_names:
+            for name in ['Time_series', 'Weights']:
+                df = self.regions[r].data[name]
+                h.update(str(list(df.columns)).encode())
+                h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        h.update(pd.util.hash_pandas_object(self.weights['Weights_n'], index=True).values.tobytes())
+        return h.hexdigest()[:16]
+
+    def read_cache(self):
+        """Reads the result of a previous clustering with the same fingerprint
+
+        If found in dat_dir/cache/<fingerprint>, the clustering (td_of_days, e_ts, Nbr_TD and tse)
+        is loaded and printed into TD_of_days_<Nbr_TD>.out and e_ts<Nbr_TD>.txt.
+
+        Returns
+        -------
+        found: bool
+            True if the cached clustering was found
+
+        """
+        cache_dir = self.dat_dir / 'cache' / self.fingerprint
+        if not (cache_dir / 'clustering.json').is_file():
+            return False
+        logging.info('Reading typical days clustering from cache ' + str(cache_dir))
+        with open(cache_dir / 'clustering.json', 'r') as fp:
+            info = json.load(fp)
+        self.Nbr_TD = info['Nbr_TD']
+        self.e_ts = info['e_ts']
+        self.tse = np.nan if info['tse'] is None else info['tse']
+        self.td_of_days = self.read_td_of_days(td_file=cache_dir / 'TD_of_days.out')
+        self.print_td_of_days(td_of_days=self.td_of_days, e_ts=self.e_ts)
+        return True
+
+    def write_cache(self):
+        """Writes the current clustering into dat_dir/cache/<fingerprint>"""
+        cache_dir = self.dat_dir / 'cache' / self.fingerprint
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.td_of_days.to_csv(cache_dir / 'TD_of_days.out', header=False, index=False, sep='\t')
+        with open(cache_dir / 'clustering.json', 'w') as fp:
+            json.dump({'Nbr_TD': int(self.Nbr_TD), 'e_ts': float(self.e_ts),
+                       'tse': None if np.isnan(self.tse) else float(self.tse)}, fp, indent=4)
+        return
+
     def read_td_of_days(self, td_file=None):
         """Reads the file containing the TD_of_days
         By default, reads the following path : self.dat_dir / ('TD_of_days_' + str(self.Nbr_TD) + '.out')
@@ -114,17 +316,52 @@ class TemporalAggregation:
         frames = list()
         frames_w = list()
         for r in self.regions_names:
-            frames.append(self.regions[r].n_daily_ts.copy())
+            if not self.compact:
+                frames.append(self.regions[r].n_daily_ts.copy())
             frames_w.append(self.regions[r].data['Weights'].copy())
 
         # concatenating and storing results into attributes
-        self.n_daily_ts = pd.concat(frames, axis=1, keys=self.regions_names)
+        if self.compact:
+            self.n_daily_ts = self.group_compact()
+        else:
+            self.n_daily_ts = pd.concat(frames, axis=1, keys=self.regions_names)
         self.weights = pd.concat(frames_w, keys=self.regions_names)
 
         # normalizing the weights accross regions
         self.normalize_weights()
         return
 
+    def group_compact(self):
+        """Normalizes, pivots and concatenates the time series of all the regions into a single float32 array
+
+        The normalized time series (sum over the year=1) of each region are reshaped to the daily format
+        and written directly into one contiguous float32 array of shape (365x(n_regions*n_ts*24)),
+        without keeping the intermediate pivoted frames of the regions.
+
+        Returns
+        -------
+        n_daily_ts: pd.DataFrame()
+            Same labels as the concatenation of the n_daily_ts of the regions, backed by the float32 array
+
+        """
+        n_cols = [self.regions[r].data['Time_series'].shape[1] * 24 for r in self.regions_names]
+        x = np.empty((365, sum(n_cols)), dtype=np.float32)
+        labels = list()
+        start = 0
+        for r, n in zip(self.regions_names, n_cols):
+            ts = self.regions[r].data['Time_series']
+            a = ts.values
+            with np.errstate(divide='ignore', invalid='ignore'):
+                a = a / a.sum(axis=0)
+            a[np.isnan(a)] = 0
+            # (8760 x n_ts) -> (365 x n_ts x 24) -> (365 x (n_ts*24)), ordered as in Region.pivot_ts
+            x[:, start:start + n] = a.reshape(365, 24, -1).transpose(0, 2, 1).reshape(365, -1)
+            labels.append(pd.MultiIndex.from_product([[r], ts.columns, np.arange(1, 25)]))
+            start += n
+        columns = labels[0].append(labels[1:]) if len(labels) > 1 else labels[0]
+        columns.names = [None, None, 'H_of_D']
+        return pd.DataFrame(x, index=pd.Index(np.arange(1, 366), name='Days'), columns=columns, copy=False)
+
     def normalize_weights(self):
         """Normalize weights across regions
 
@@ -161,58 +398,194 @@ class TemporalAggregation:
         return
 
 
-    def weight(self):
+    def weight(self, reduction=None, **kwargs):
         """Weighting the normalized daily time series
 
         The normalized daily concatenated time series (n_daily_ts) are weighted by the normalized weights (weights['Weights_n']).
         The time series with no weight or a null weight are dropped.
         The result (n_data) is ready to be used in a clustering algorithm and is of shape (365x(len(non_null_weights)*24))
 
-        """
-        # use numpy broadcasting to multiply each time series by its weight
-        self.n_data = self.numpy_broadcasting(self.weights.loc[:,'Weights_n'],self.n_daily_ts.transpose())
-        # drop ts without weight
-        self.n_data.dropna(axis=0, how='any', inplace=True)
-        self.n_data = self.n_data.transpose() # transpose to the form (365x(n_ts*n_regions*24))
+        With many regions, n_data can optionally be projected into a space of lower dimension
+        (see esmc.preprocessing.clustering.reduce_dimensions). The clustering algorithms then work
+        on the reduced n_data and the distortion of the distances between days is stored into the distortion attribute.
 
-        return
+        Parameters
+        ----------
+        reduction: {None, 'pca', 'random_projection'}
+            Dimensionality reduction method, None to keep the full weighted time series
+        kwargs:
+            Options of the dimensionality reduction (explained_variance, n_components, random_state)
 
-    def print_dat(self, dat_file=None):
         """
+        if self.compact:
+            # weight of each column of n_daily_ts, keeping only the columns with a weight
+            columns = self.n_daily_ts.columns
+            w = self.weights['Weights_n'].reindex(pd.MultiIndex.from_arrays([columns.get_level_values(0),
+                                                                              columns.get_level_values(1)])).values
+            keep = ~np.isnan(w)
+            self.n_data = pd.DataFrame(self.n_daily_ts.values[:, keep] * w[keep].astype(np.float32),
+                                       index=self.n_daily_ts.index, columns=columns[keep], copy=False)
+        else:
+            # use numpy broadcasting to multiply each time series by its weight
+            self.n_data = self.numpy_broadcasting(self.weights.loc[:,'Weights_n'],self.n_daily_ts.transpose())
+            # drop ts without weight
+            self.n_data.dropna(axis=0, how='any', inplace=True)
+            self.n_data = self.n_data.transpose() # transpose to the form (365x(n_ts*n_regions*24))
+
+        if reduction is not None:
+            x = self.n_data.values
+            x_reduced = cl.reduce_dimensions(x, method=reduction, **kwargs)
+            self.distortion = cl.distance_distortion(x, x_reduced)
+            logging.info('Reduced n_data from ' + str(x.shape[1]) + ' to ' + str(x_reduced.shape[1])
+                         + ' dimensions with ' + reduction + ', relative error on the distances between days: mean '
+                         + str(round(self.distortion['mean'], 4)) + ', max ' + str(round(self.distortion['max'], 4)))
+            self.n_data = pd.DataFrame(x_reduced, index=self.n_data.index,
+                                       columns=[reduction + '_' + str(i) for i in range(x_reduced.shape[1])])
+        return
 
-        Parameters
-        ----------
-        dat_file
+    def n_data_key(self):
+        """Returns a short hash of n_data, used to name the files computed from it"""
+        n_data = np.ascontiguousarray(self.n_data.values, dtype=np.float64)
+        return hashlib.sha1(str(n_data.shape).encode() + n_data.tobytes()).hexdigest()[:16]
+
+    def distance_matrix(self):
+        """Computes the L1 distance matrix between the days of n_data
+
+        The matrix is computed in NumPy (float32, by blocks) and cached into
+        dat_dir/distance_<key>.npy where key is a hash of n_data.
+        Any clustering on the same n_data (e.g. for another Nbr_TD) reuses the cached matrix.
+        Without dimensionality reduction, the matrix is the sum of the distance matrices of each time series
+        of each region multiplied by their weight (see distance_blocks), such that only the time series
+        that changed since the last computation are recomputed.
 
         Returns
         -------
+        distance: np.ndarray
+            Symmetric (365x365) L1 distance matrix, also stored into the distance attribute
+
+        """
+        if self.distance is not None:
+            return self.distance
+
+        distance_file = self.dat_dir / ('distance_' + self.n_data_key() + '.npy')
+        if distance_file.is_file():
+            logging.info('Reading distance matrix from ' + str(distance_file))
+            self.distance = np.load(distance_file)
+        else:
+            logging.info('Computing distance matrix and saving it into ' + str(distance_file))
+            if self.reduction is None:
+                # weighted sum of the distances of each time series (weights are positive),
+                # each block being added as soon as it is read or computed
+                distance = np.zeros((self.n_data.shape[0], self.n_data.shape[0]))
+                for (r, ts), d in self.distance_blocks():
+                    distance += self.weights.loc[(r, ts), 'Weights_n'] * d
+                self.distance = distance.astype(np.float32)
+            else:
+                self.distance = cl.l1_distance_matrix(self.n_data.values)
+            np.save(distance_file, self.distance)
+        return self.distance
+
+    def distance_blocks(self):
+        """Reads or computes the L1 distance matrix between the days of each weighted time series of each region
+
+        The distance matrices are computed on the normalized daily time series (n_daily_ts), before weighting.
+        They are cached in float32 with the clustering, into
+        dat_dir/cache/<fingerprint>/distance_blocks/<region>/<ts>/<key>.npy where key is a hash of the time series.
+        The matrices of a previous clustering that are still valid (e.g. the ones of the regions whose time series
+        were not updated) are moved from its cache directory instead of being recomputed. The matrices left in the
+        other cache directories (outdated time series) are then removed, such that only the matrices of the last
+        clustering are kept on disk (about 180 MB for 34 regions).
+
+        Yields
+        ------
+        (r, ts), block: tuple, np.ndarray
+            Distance matrix (365x365, float32) of each (region, time series) having a normalized weight,
+            one at a time such that the caller can sum them without holding all of them in memory
+
+        """
+        cache_dir = self.dat_dir / 'cache'
+        blocks_dir = cache_dir / self.fingerprint / 'distance_blocks'
+        blocks_dir.mkdir(parents=True, exist_ok=True)
+        n_computed = 0
+        n_read = 0
+        # positions of the columns of each (region, time series) in n_daily_ts
+        columns = self.n_daily_ts.columns
+        positions = pd.DataFrame({'r': columns.get_level_values(0), 'ts': columns.get_level_values(1)}) \
+            .groupby(['r', 'ts'], sort=False).indices
+        for r, ts in self.weights['Weights_n'].dropna().index:
+            x = np.ascontiguousarray(self.n_daily_ts.values[:, positions[(r, ts)]], dtype=np.float64)
+            key = hashlib.sha1(str(x.shape).encode() + x.tobytes()).hexdigest()[:16]
+            # one directory per time series of each region, such that the names cannot overlap
+            block_path = Path(str(r)) / str(ts) / (key + '.npy')
+            block_file = blocks_dir / block_path
+            if not block_file.is_file():
+                # matrix computed for a previous clustering
+                for d in cache_dir.iterdir():
+                    if (d / 'distance_blocks' / block_path).is_file():
+                        block_file.parent.mkdir(parents=True, exist_ok=True)
+                        try:
+                            os.replace(d / 'distance_blocks' / block_path, block_file)
+                        except OSError:
+                            continue
+                        break
+            try:
+                block = np.load(block_file)
+                n_read += 1
+            except OSError:
+                block = cl.l1_distance_matrix(x, dtype=np.float64).astype(np.float32)
+                block_file.parent.mkdir(parents=True, exist_ok=True)
+                # saved into a temporary file, such that a partially written matrix is never read
+                tmp_file = block_file.with_name(key + '.' + uuid.uuid4().hex + '.tmp')
+                with open(tmp_file, 'wb') as fp:
+                    np.save(fp, block)
+                os.replace(tmp_file, block_file)
+                n_computed += 1
+            yield (r, ts), block
+        # remove the outdated matrices of the other clusterings
+        for d in cache_dir.iterdir():
+            if d.name != self.fingerprint:
+                shutil.rmtree(d / 'distance_blocks', ignore_errors=True)
+        logging.info('Computed ' + str(n_computed) + ' and read ' + str(n_read)
+                     + ' distance matrices of time series')
+
+    def print_dat(self, dat_file=None):
+        """Prints the .dat file of the kmedoid clustering MILP (TD_main.mod)
+
+        Only the distance matrix between the days is given to ampl,
+        the weights of the time series are printed as a comment.
+
+        Parameters
+        ----------
+        dat_file: pathlib.Path
+            Path of the .dat file, by default self.dat_dir / ('data_' + str(self.Nbr_TD) + '.dat')
 
         """
         if dat_file is None:
             # path to the .dat file
             dat_file = self.dat_dir / ('data_' + str(self.Nbr_TD) + '.dat')
 
-        # set n_data columns index to numerical index
-        n_data = self.n_data.copy()
-        n_data.columns = np.arange(1, self.n_data.shape[1] + 1)
-
-        # printing signature of data file
-        dp.print_header(dat_file=dat_file, header_file=Path(__file__).parent/'kmedoid_clustering'/'header.txt')
-        # printing SET DIMENSIONS
-        dp.print_set(my_set=[str(i) for i in n_data.columns], out_path=dat_file, name='DIMENSIONS')
+        # distance matrix with days numbered from 1 to 365
+        days = np.arange(1, self.n_data.shape[0] + 1)
+        distance = pd.DataFrame(self.distance_matrix(), index=days, columns=days)
 
-        # printing Nbr_TD
-        dp.print_param(self.Nbr_TD, dat_file, name='Nbr_TD')
-        dp.newline(dat_file)
-        # printing weights as a comment
+        # weights printed as a comment
         weights = self.weights.copy()
         weights = weights.reset_index().rename(columns={'level_0':'Regions', 'level_1':'Time series'})
         weights['#'] = '#'
         weights = weights[['#', 'Regions', 'Time series', 'Weights', 'Cell_w', 'Weights_n']]
-        weights.to_csv(dat_file, sep='\t', header=True, index=False, mode='a')
-        dp.newline(dat_file)
-        # printing param n_data in ampl syntax
-        dp.print_df(df=dp.ampl_syntax(n_data), out_path=dat_file, name='param Ndata :')
+
+        with dp.DatWriter(dat_file) as w:
+            # printing signature of data file
+            w.print_header(header_file=Path(__file__).parent/'kmedoid_clustering'/'header.txt')
+
+            # printing Nbr_TD
+            w.print_param(self.Nbr_TD, name='Nbr_TD')
+            w.newline()
+            # printing weights as a comment
+            w.to_csv(weights, sep='\t', header=True, index=False)
+            w.newline()
+            # printing param Distance in ampl syntax
+            w.print_df(df=dp.ampl_syntax(distance), name='param Distance :')
         return
 
     def kmedoid_clustering(self, ampl_path=None):
@@ -258,13 +631,10 @@ class TemporalAggregation:
         cm.index.name = None
         td_of_days = pd.DataFrame(cm.mul(np.arange(1, 366), axis=0).sum(axis=0), index=np.arange(1,366),
                                   columns=['TD_of_days']).astype(int)
-        td_of_days.to_csv(self.dat_dir/('TD_of_days_'+str(self.Nbr_TD)+'.out'), header=False, index=False, sep='\t')
 
-        # get the clustering error and printong it
-        self.e_ts = my_optimizer.ampl.get_objective('Euclidean_distance').value()
-        with open(self.dat_dir/('e_ts'+str(self.Nbr_TD)+'.txt'), mode='w', newline='') as file:
-            writer = csv.writer(file, delimiter='\t', quotechar=' ', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow([str(self.e_ts)])
+        # get the clustering error and print it with td_of_days
+        self.e_ts = self.clustering_error(td_of_days, my_optimizer.ampl.get_objective('Euclidean_distance').value())
+        self.print_td_of_days(td_of_days=td_of_days, e_ts=self.e_ts)
 
         # closing ampl object
         my_optimizer.ampl.close()
@@ -274,11 +644,209 @@ class TemporalAggregation:
         logging.info('End of typical days clustering')
         return td_of_days
 
+    def pam_clustering(self):
+        """Selects the typical days with the PAM k-medoids algorithm implemented in NumPy
+
+        Solves the same problem as the MILP in TD_main.mod (minimizing the sum of the L1 distances
+        between each day and the typical day representing it) without calling a solver.
+        The result is printed into TD_of_days_<Nbr_TD>.out and e_ts<Nbr_TD>.txt
+        such that it can be read afterwards with algo='read'.
+
+        Returns
+        -------
+        td_of_days: pd.DataFrame()
+            Typical day (number of the day in the year) representing each day of the year
+
+        """
+        # logging info
+        logging.info('Starting PAM clustering of typical days')
+
+        # start from the medoids of the previous clustering, if any
+        init = None
+        td_file = self.dat_dir / ('TD_of_days_' + str(self.Nbr_TD) + '.out')
+        if self.warm_start and td_file.is_file():
+            init = np.unique(self.read_td_of_days(td_file=td_file)['TD_of_days'].values) - 1
+
+        # compute distance matrix and run the k-medoids algorithm
+        medoids, labels, e_ts = cl.pam(self.distance_matrix(), k=self.Nbr_TD, init=init)
+        td_of_days = pd.DataFrame(labels + 1, index=np.arange(1, 366), columns=['TD_of_days'])
+        self.e_ts = self.clustering_error(td_of_days, e_ts)
+        self.print_td_of_days(td_of_days=td_of_days, e_ts=self.e_ts)
+
+        # logging info
+        logging.info('End of typical days clustering')
+        return td_of_days
+
+    def hierarchical_clustering(self, method='ward'):
+        """Selects the typical days by cutting a hierarchical clustering of the days
+
+        The dendrogram is built once for a given n_data and saved into dat_dir/linkage_<method>_<key>.out
+        (key being a hash of n_data). Cutting it for any number of typical days is then immediate.
+        Each cluster is represented by its medoid (according to the L1 distance matrix).
+        The result is printed into TD_of_days_<Nbr_TD>.out and e_ts<Nbr_TD>.txt.
+
+        Parameters
+        ----------
+        method: {'ward', 'medoid_linkage'}
+            Linkage method of the hierarchical clustering
+
+        Returns
+        -------
+        td_of_days: pd.DataFrame()
+            Typical day (number of the day in the year) representing each day of the year
+
+        """
+        # logging info
+        logging.info('Starting hierarchical clustering (' + method + ') of typical days')
+
+        labels = cl.cut_linkage(self.linkage(method=method), k=self.Nbr_TD)
+        medoids, e_ts = cl.medoids_of_clusters(self.distance_matrix(), labels)
+        td_of_days = pd.DataFrame(medoids + 1, index=np.arange(1, 366), columns=['TD_of_days'])
+        self.e_ts = self.clustering_error(td_of_days, e_ts)
+        self.print_td_of_days(td_of_days=td_of_days, e_ts=self.e_ts)
+
+        # logging info
+        logging.info('End of typical days clustering')
+        return td_of_days
+
+    def linkage(self, method='ward'):
+        """Reads or computes the linkage matrix of the hierarchical clustering of the days
+
+        Parameters
+        ----------
+        method: {'ward', 'medoid_linkage'}
+            Linkage method of the hierarchical clustering
+
+        Returns
+        -------
+        z: np.ndarray
+            Linkage matrix (see esmc.preprocessing.clustering.linkage)
+
+        """
+        linkage_file = self.dat_dir / ('linkage_' + method + '_' + self.n_data_key() + '.out')
+        if linkage_file.is_file():
+            logging.info('Reading dendrogram from ' + str(linkage_file))
+            z = np.loadtxt(linkage_file, delimiter='\t', ndmin=2)
+        else:
+            logging.info('Computing dendrogram and saving it into ' + str(linkage_file))
+            z = cl.linkage(self.distance_matrix(), method=method, x=self.n_data.values)
+            np.savetxt(linkage_file, z, fmt=['%d', '%d', '%.12g', '%d'], delimiter='\t')
+        return z
+
+    def sweep(self, nbr_tds: list, algo='pam'):
+        """Clusters the days for several numbers of typical days in one pass
+
+        The distance matrix is computed once and the numbers of typical days are treated in increasing order,
+        the clustering with k typical days being warm-started from the medoids of the previous one.
+        The results are printed into TD_of_days_<k>.out and e_ts<k>.txt for each k in nbr_tds.
+        The attributes (Nbr_TD, td_of_days, e_ts) of the object are not modified.
+
+        Parameters
+        ----------
+        nbr_tds: list
+            List of the numbers of typical days to compute
+        algo: {'pam', 'ward', 'medoid_linkage'}
+            Clustering algorithm to use. For the hierarchical algorithms,
+            all the numbers of typical days are obtained by cutting the same dendrogram.
+
+        Returns
+        -------
+        td_of_days: pd.DataFrame()
+            Typical day representing each day of the year (index) for each number of typical days (columns)
+        e_ts: pd.Series()
+            Clustering error for each number of typical days
+
+        """
+        if algo not in ['pam', 'ward', 'medoid_linkage']:
+            raise ValueError('Sweep is not implemented for algo=' + str(algo))
+        nbr_tds = sorted(set(int(k) for k in nbr_tds))
+        logging.info('Starting sweep of typical days clustering over ' + str(len(nbr_tds)) + ' numbers of TDs')
+
+        distance = self.distance_matrix()
+        td_of_days = pd.DataFrame(0, index=np.arange(1, 366), columns=nbr_tds)
+        e_ts = pd.Series(np.nan, index=nbr_tds)
+        if algo == 'pam':
+            medoids = None
+            for k in nbr_tds:
+                medoids, labels, e_ts[k] = cl.pam(distance, k=k, init=medoids)
+                td_of_days[k] = labels + 1
+        else:
+            z = self.linkage(method=algo)
+            for k in nbr_tds:
+                labels, e_ts[k] = cl.medoids_of_clusters(distance, cl.cut_linkage(z, k=k))
+                td_of_days[k] = labels + 1
+
+        # printing all the results
+        for k in nbr_tds:
+            e_ts[k] = self.clustering_error(td_of_days[k], e_ts[k])
+            self.print_td_of_days(td_of_days=td_of_days[[k]], e_ts=e_ts[k], nbr_td=k)
+
+        logging.info('End of sweep of typical days clustering')
+        return td_of_days, e_ts
+
+    def clustering_error(self, td_of_days, e_ts):
+        """Clustering error of td_of_days on the weighted time series, before the dimensionality reduction
+
+        The clustering error is the sum over the days of the L1 distance between the weighted normalized
+        time series of each day and the ones of the typical day representing it, i.e. the objective
+        of the clustering algorithms. With a dimensionality reduction, they minimize the distances in the reduced space:
+        the error is then computed again on the weighted time series, such that it is comparable with the
+        errors of the clusterings without reduction. Without reduction, e_ts is returned as such.
+
+        Parameters
+        ----------
+        td_of_days: pd.DataFrame() or pd.Series()
+            Typical day (number of the day in the year) representing each day of the year
+        e_ts: float
+            Objective of the clustering algorithm
+
+        Returns
+        -------
+        e_ts: float
+            Clustering error on the weighted time series
+
+        """
+        if self.reduction is None:
+            return e_ts
+        # weight of each column of n_daily_ts, the columns without weight being dropped as in n_data
+        columns = self.n_daily_ts.columns
+        w = self.weights['Weights_n'].reindex(pd.MultiIndex.from_arrays([columns.get_level_values(0),
+                                                                          columns.get_level_values(1)])).values
+        keep = ~np.isnan(w)
+        x = self.n_daily_ts.values[:, keep].astype(np.float64)
+        medoids = np.asarray(td_of_days).ravel() - 1
+        error = float((np.abs(x - x[medoids]) @ w[keep]).sum())
+        logging.info('Clustering error of ' + str(e_ts) + ' in the reduced space and of ' + str(error)
+                     + ' on the weighted time series')
+        return error
+
+    def print_td_of_days(self, td_of_days, e_ts, nbr_td=None):
+        """Prints the result of a clustering into TD_of_days_<nbr_td>.out and e_ts<nbr_td>.txt
+
+        Parameters
+        ----------
+        td_of_days: pd.DataFrame()
+            Typical day representing each day of the year
+        e_ts: float
+            Clustering error (see clustering_error)
+        nbr_td: int
+            Number of typical days of the clustering, by default self.Nbr_TD
+
+        """
+        if nbr_td is None:
+            nbr_td = self.Nbr_TD
+        td_of_days.to_csv(self.dat_dir/('TD_of_days_'+str(nbr_td)+'.out'), header=False, index=False, sep='\t')
+        with open(self.dat_dir/('e_ts'+str(nbr_td)+'.txt'), mode='w', newline='') as file:
+            writer = csv.writer(file, delimiter='\t', quotechar=' ', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow([str(e_ts)])
+        return
+
     def generate_t_h_td(self):
         """Generate t_h_td and td_count dataframes and assign it to each region
         t_h_td is a pd.DataFrame containing 4 columns:
         hour of the year (H_of_Y), hour of the day (H_of_D), typical day representing this day (TD_of_days)
-        and the number assigned to this typical day (TD_number)
+        and the number assigned to this typical day (TD_number).
+        If period_duration > 1, H_of_Y and H_of_D are the periods of the year and of the day.
 
         td_count is a pd.DataFrame containing 2 columns:
         List of typical days (TD_of_days) and number of days they represent (#days)
@@ -293,42 +861,159 @@ class TemporalAggregation:
         td_count['TD_number'] = np.arange(1, self.Nbr_TD + 1)
 
         # BUILDING T_H_TD MATRICE
-        t_h_td = pd.DataFrame(np.repeat(td_of_days['TD_of_days'].values, 24, axis=0),
+        n_periods = 24 // self.period_duration # number of periods in a day
+        t_h_td = pd.DataFrame(np.repeat(td_of_days['TD_of_days'].values, n_periods, axis=0),
                               columns=['TD_of_days'])  # column TD_of_days is each TD repeated 24 times
         map_td = dict(zip(td_count['TD_of_days'],
                           np.arange(1, self.Nbr_TD + 1)))  # mapping dictionnary from TD_of_Days to TD number
         t_h_td['TD_number'] = t_h_td['TD_of_days'].map(map_td)
-        t_h_td['H_of_D'] = np.resize(np.arange(1, 25), t_h_td.shape[0])  # 365 times hours from 1 to 24
-        t_h_td['H_of_Y'] = np.arange(1, 8761)
+        t_h_td['H_of_D'] = np.resize(np.arange(1, n_periods + 1), t_h_td.shape[0])  # 365 times hours from 1 to 24
+        t_h_td['H_of_Y'] = np.arange(1, 365 * n_periods + 1)
         # save into TemporalAggregation object
         self.t_h_td = t_h_td
         self.td_count = td_count
+        # position of each hour of the year in a (TD_number, H_of_D) ordered array
+        self.td_h_of_y = ((np.repeat(t_h_td['TD_number'].to_numpy(), self.period_duration) - 1) * n_periods
+                          + np.repeat(t_h_td['H_of_D'].to_numpy(), self.period_duration) - 1)
 
         #logging info
         logging.info('t_h_td and td_count generated')
         return
 
+    def rescale_td_ts(self):
+        """Select and rescale the time series of the typical days of all the regions
+
+        Batched version of Region.rescale_td_ts: the regions having the same time series
+        are stacked into one (n_regions x 8760 x N_ts) array and rescaled at once.
+        The result is stored into the ts_td attribute of each region.
+
+        """
+        groups = dict()
+        for r in self.regions_names:
+            groups.setdefault(tuple(self.regions[r].data['Time_series'].columns), list()).append(r)
+        for ts_names, regions in groups.items():
+            ts = np.stack([self.regions[r].data['Time_series'].values for r in regions])
+            ts_td = Region.rescale_td_array(ts, td_count=self.td_count)
+            for i, r in enumerate(regions):
+                self.regions[r].ts_td = Region.td_array_to_df(ts_td[i], ts_names=list(ts_names),
+                                                              td_count=self.td_count)
+        return
+
+    def aggregate_periods(self, ts_td: pd.DataFrame, how='sum'):
+        """Aggregates the hourly time series of the typical days into periods of period_duration hours
+
+        Parameters
+        ----------
+        ts_td: pd.DataFrame()
+            Time series of the typical days, indexed by (time series, H_of_D) with the 24 hours of each time series
+        how: {'sum', 'mean'}
+            'sum' for the shares of yearly demands (the energy over each period is conserved),
+            'mean' for the capacity factors
+
+        Returns
+        -------
+        ts_td: pd.DataFrame()
+            Time series of the typical days, indexed by (time series, H_of_D) with H_of_D the periods of the day
+
+        """
+        if self.period_duration == 1:
+            return ts_td
+        n_periods = 24 // self.period_duration
+        a = self.aggregate_periods_array(ts_td.values.reshape(-1, 24, ts_td.shape[1]), how=how)
+        index = pd.MultiIndex.from_product([ts_td.index.unique(level=0), np.arange(1, n_periods + 1)],
+                                           names=ts_td.index.names)
+        return pd.DataFrame(a.reshape(-1, ts_td.shape[1]), index=index, columns=ts_td.columns)
+
+    def aggregate_periods_array(self, ts_td: np.ndarray, how='sum'):
+        """Aggregates the hours of an array of time series of the typical days into periods of period_duration hours
+
+        Parameters
+        ----------
+        ts_td: np.ndarray
+            Time series of the typical days of shape (..., 24, Nbr_TD)
+        how: {'sum', 'mean'}
+            'sum' for the shares of yearly demands, 'mean' for the capacity factors
+
+        Returns
+        -------
+        Array of shape (..., 24 // period_duration, Nbr_TD)
+
+        """
+        if self.period_duration == 1:
+            return ts_td
+        a = ts_td.reshape(ts_td.shape[:-2] + (24 // self.period_duration, self.period_duration, ts_td.shape[-1]))
+        return a.sum(axis=-2) if how == 'sum' else a.mean(axis=-2)
+
     def from_td_to_year(self, ts_td):
         """Converts time series on TDs to yearly time series
 
+        The rows of ts_td are gathered with a precomputed integer map from (TD_number, H_of_D) to the hours
+        of the year (td_h_of_y). It should only be used when the full yearly series are needed,
+        yearly totals can be computed directly on the TDs with year_total.
+
         Parameters
         ----------
         ts_td: pandas.DataFrame
         Multiindex dataframe of hourly data for each hour of each TD.
         The index should be of the form (TD_number, hour_of_the_day).
+        With period_duration > 1, hour_of_the_day is the period of the day.
 
-        t_h_td: pandas.DataFrame
-
+        Returns
+        -------
+        ts_yr: pandas.DataFrame
+        Data of ts_td for each hour of the year, indexed by the position of the hour in the year (0 to 8759).
+        With period_duration > 1, the data of each period is repeated for each of its hours.
+        If several rows of ts_td correspond to the same (TD_number, hour_of_the_day),
+        they are all repeated for each hour of the year.
 
         """
         if self.t_h_td is None:
             self.generate_t_h_td()
 
-        td_h = self.t_h_td.loc[:, ['TD_number', 'H_of_D']]
-        ts_yr = td_h.merge(ts_td, left_on=['TD_number', 'H_of_D'], right_index=True).sort_index()
-        return ts_yr.drop(columns=['TD_number', 'H_of_D'])
+        # position of each row of ts_td in the (TD_number, H_of_D) ordered array
+        n_periods = 24 // self.period_duration
+        key = (ts_td.index.get_level_values(0).to_numpy(dtype=int) - 1) * n_periods \
+            + ts_td.index.get_level_values(1).to_numpy(dtype=int) - 1
+        # rows of ts_td ordered by key, and number of rows for each key
+        order = np.argsort(key, kind='stable')
+        counts = np.bincount(key, minlength=self.Nbr_TD * n_periods)
+        starts = np.cumsum(counts) - counts
+        # rows of ts_td to take for each hour of the year
+        rep = counts[self.td_h_of_y]
+        offset = np.arange(rep.sum()) - np.repeat(np.cumsum(rep) - rep, rep)
+        take = order[np.repeat(starts[self.td_h_of_y], rep) + offset]
+
+        ts_yr = ts_td.reset_index(drop=True).take(take)
+        ts_yr.index = np.repeat(np.arange(8760), rep)
+        return ts_yr
+
+    def year_total(self, ts_td, by: list):
+        """Computes totals over the year of data defined on the TDs, without converting them to yearly time series
+
+        Each row is multiplied by the number of days represented by its TD
+        (and by the duration of the periods, t_op) before summing it
 
+        Parameters
+        ----------
+        ts_td: pandas.DataFrame
+        Multiindex dataframe of hourly data for each hour of each TD.
+        The index should be of the form (TD_number, hour_of_the_day).
+        by: list
+        Columns of ts_td to group by, all the other columns are summed over the year
+
+        Returns
+        -------
+        tot_yr: pandas.DataFrame
+        Totals over the year of the columns of ts_td not in by, indexed by the columns in by
+
+        """
+        if self.t_h_td is None:
+            self.generate_t_h_td()
 
+        n_days = self.td_count.set_index('TD_number')['#days'] \
+            .reindex(ts_td.index.get_level_values(0).to_numpy(dtype=int)).to_numpy() * self.period_duration
+        values = ts_td.drop(columns=by).mul(n_days, axis=0)
+        return values.groupby([ts_td[c] for c in by]).sum()
 
     @staticmethod
     def numpy_broadcasting(df0, df1):
@@ -3,17 +3,21 @@ This file contains a class to define an energy system
 
 """
 import logging
-import copy
 import numpy as np
 from esmc.utils.region import Region
+from esmc.utils.ts_cube import TimeSeriesCube
 from esmc.utils.opti_probl import OptiProbl
 from esmc.preprocessing.temporal_aggregation import TemporalAggregation
 import esmc.preprocessing.dat_print as dp
 import esmc.postprocessing.amplpy2pd as a2p
 from esmc.utils.df_utils import clean_indices
 from esmc.common import CSV_SEPARATOR, AMPL_SEPARATOR, named_space_id
+import os
 import shutil
 import git
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from functools import partial
 import pandas as pd
 import csv
 from pathlib import Path
@@ -53,7 +57,7 @@ class Esmc:
 
     """
 
-    def __init__(self, config, nbr_td=14):
+    def __init__(self, config, nbr_td=14, period_duration=1):
         # identification of case study
         self.case_study = config['case_study']
         self.comment = config['comment']
@@ -65,6 +69,10 @@ class Esmc:
         if self.space_id in named_space_id.keys():
             self.space_id = named_space_id[self.space_id]
         self.nbr_td = nbr_td
+        # number of hours aggregated in each period of the typical days (1 for an hourly resolution)
+        if 24 % period_duration != 0:
+            raise ValueError('period_duration should divide 24, got ' + str(period_duration))
+        self.period_duration = period_duration
         # TODO integrate in print .dat
         self.gwp_limit_overall = config['gwp_limit_overall']  # None or number
         self.re_share_primary = config['re_share_primary']  # None or dict giving the re_share_primary in each region
@@ -78,6 +86,11 @@ class Esmc:
         # create directories
         self.dat_dir.mkdir(parents=True, exist_ok=True)
         self.cs_dir.mkdir(parents=True, exist_ok=True)
+        # store of the .dat files shared by the case studies of the spatial case study
+        self.dat_store = dp.DatStore(self.project_dir / 'case_studies' / self.space_id / '00_dat_store')
+        # pool of processes printing the .dat files and their pending jobs (see print_dat)
+        self.dat_pool = None
+        self.dat_jobs = list()
 
         # create and initialize regions
         self.ref_region_name = '02_REF_REGION' #  config['ref_region']
@@ -90,9 +103,13 @@ class Esmc:
                                          ])  # data independent from regions considered
         self.data_reg = dict.fromkeys(['Exch', 'Demands', 'Technologies',
                                        'Storage_power_to_energy', 'Misc'])  # data specific to regions considered
+        # log of the cells of the regions data changed through update_data
+        self.data_changes = pd.DataFrame(columns=['Table', 'Regions', 'Index', 'Column', 'Old', 'New'])
 
         # initialize TemporalAggregation object
         self.ta = None
+        # data depending on the typical days, from the last call of compute_td_data (see push_td_data)
+        self.td_data = None
         # TODO self.spatial_aggreg = object spatial_aggreg
         #
 
@@ -112,28 +129,90 @@ class Esmc:
 
     # TODO add an automated initialization for specific pipeline
 
-    def init_regions(self):
+    def init_regions(self, n_workers=None, ts_cube=False, lazy=False):
+        """Initialize the regions and read their data
+
+        The reference region is read first, then the data of the other regions are read concurrently
+        in a pool of threads (the parsing of the csv files releasing the GIL).
+        The other regions share the tables of the reference region and only store the values they redefine,
+        a table being copied from the reference region at its first access (see RegionData).
+        The regions are stored in the order of regions_names whatever the order in which their reading ends.
+
+        Parameters
+        ----------
+        n_workers: int
+            Number of threads reading the data of the regions, by default min(32, number of cpus + 4).
+            Use n_workers=1 for a sequential reading.
+        ts_cube: bool
+            If True, the time series of the regions are read-only float32 views of a cube memory-mapped from
+            Data/<year>/.cache (see TimeSeriesCube), shared between the processes running cases on the same year.
+            The time series must then be replaced, not modified in place.
+        lazy: bool
+            If True, the data of the regions are not read here but each table at its first access
+            (e.g. for analysis sessions not needing the time series). Otherwise, all the data are read.
+
+        """
         logging.info('Initialising regions: ' + ', '.join(self.regions_names))
         data_dir = self.project_dir / 'Data' / str(self.year)
-        self.ref_region = Region(nuts=self.ref_region_name, data_dir=data_dir, ref_region=True)
+        cube = TimeSeriesCube(data_dir) if ts_cube else None
+        self.ref_region = Region(nuts=self.ref_region_name, data_dir=data_dir, ref_region=True, ts_cube=cube,
+                                 lazy=True)
+        if not lazy:
+            # read before the other regions as they take the tables they do not redefine from it
+            self.ref_region.prefetch()
+
+        def init_region(r):
+            # the region shares the data of the reference region and only stores the values it redefines
+            region = Region(nuts=r, data_dir=data_dir, ref_region=False, ts_cube=cube, ref_data=self.ref_region.data,
+                            lazy=True)
+            if not lazy:
+                region.prefetch()
+            return region
+
+        to_read = [r for r in self.regions_names if r != self.ref_region_name]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            regions = dict(zip(to_read, executor.map(init_region, to_read)))
         for r in self.regions_names:
-            if r != self.ref_region_name:
-                self.regions[r] = copy.deepcopy(self.ref_region)
-                self.regions[r].__init__(nuts=r, data_dir=data_dir, ref_region=False)
-            else:
-                self.regions[r] = self.ref_region
+            self.regions[r] = regions[r] if r != self.ref_region_name else self.ref_region
 
         self.read_data_exch()
         return
 
-    def init_ta(self, algo='kmedoid', ampl_path=None):
+    def init_ta(self, algo='kmedoid', ampl_path=None, target_tse=None, reduction=None, reduction_options=None,
+                warm_start=False, use_cache=True, compact=False):
         """Initialize the temporal aggregator
 
+        Parameters
+        ----------
+        algo: {'kmedoid', 'pam', 'ward', 'medoid_linkage', 'read'}
+            Clustering algorithm used to select the typical days
+        ampl_path: pathlib.Path
+            Path to ampl, only used by the 'kmedoid' algorithm
+        target_tse: float
+            If given, the number of typical days (nbr_td) is replaced by the smallest one
+            having an a priori time series error below target_tse
+        reduction: {None, 'pca', 'random_projection'}
+            Dimensionality reduction of the data to cluster (see TemporalAggregation.weight)
+        reduction_options: dict
+            Options of the dimensionality reduction (explained_variance, n_components, random_state)
+        warm_start: bool
+            If True, the 'pam' algorithm starts from the typical days of the previous clustering
+            (e.g. after updating the time series of some regions)
+        use_cache: bool
+            If True, the result of a previous clustering with the same inputs is reused (see TemporalAggregation)
+        compact: bool
+            If True, the data to cluster is stored into float32 arrays to reduce the memory usage
+
         """
         logging.info('Initializing TemporalAggregation with ' + algo + ' algorithm')
         self.ta = TemporalAggregation(self.regions, self.dat_dir, Nbr_TD=self.nbr_td, algo=algo,
-                                      ampl_path=ampl_path,
+                                      ampl_path=ampl_path, target_tse=target_tse,
+                                      reduction=reduction, reduction_options=reduction_options, warm_start=warm_start,
+                                      use_cache=use_cache, compact=compact, period_duration=self.period_duration,
                                       time_series_mapping=self.data_indep['Misc_indep']['time_series_mapping'])
+        self.nbr_td = self.ta.Nbr_TD
+        # the data depending on the previous typical days are outdated
+        self.td_data = None
         return
 
     def update_version(self):
@@ -268,13 +347,14 @@ class Esmc:
                 frames[c] = list()
 
             for n, r in self.regions.items():
+                # the tables are read without being copied into the regions (see RegionData.view)
                 if c == 'Misc':
-                    d = r.data[c].copy()
+                    d = dict(r.data.view(c))
                     share_ned = d.pop('share_ned')
                     frames[c]['misc'].append(pd.Series(d))
                     frames[c]['share_ned'].append(pd.Series(share_ned))
                 else:
-                    frames[c].append(r.data[c].copy())
+                    frames[c].append(r.data.view(c))
 
         # Concatenate and store into a tuple
         out = tuple()
@@ -290,174 +370,358 @@ class Esmc:
 
         return out
 
-    def print_data(self, indep=False):
+    def stack_reg_data(self, table: str, regions=None, index=None, columns=None):
+        """Stacks a selection of a table of several regions into a single dataframe
+
+        Parameters
+        ----------
+        table : str
+            Name of the table ('Demands', 'Resources', 'Technologies', 'Storage_power_to_energy' or 'Misc')
+        regions : list
+            Regions to stack, by default all the regions
+        index : label or list
+            Rows of the table to select (e.g. technologies), by default all of them. Not used for Misc.
+        columns : label or list
+            Columns of the table (keys of Misc) to select, by default all of them.
+            The dictionaries of Misc (e.g. share_ned) are not selected by default.
+
+        Returns
+        -------
+        Dataframe indexed by (Regions, index) (by Regions for Misc) with the selected columns
+
+        """
+        def to_list(labels):
+            return labels if isinstance(labels, slice) else [labels] if isinstance(labels, str) else list(labels)
+
+        if regions is None:
+            regions = self.regions_names
+        regions = to_list(regions)
+        index = slice(None) if index is None else to_list(index)
+        columns = slice(None) if columns is None else to_list(columns)
+
+        if table == 'Misc':
+            misc = {r: {k: v for k, v in self.regions[r].data.view('Misc').items() if not isinstance(v, dict)}
+                    for r in regions}
+            df = pd.DataFrame.from_dict(misc, orient='index').loc[:, columns]
+            df.index.name = 'Regions'
+            return df
+        return pd.concat([self.regions[r].data.view(table).loc[index, columns] for r in regions], axis=0,
+                         keys=regions, names=['Regions'])
+
+    def update_data(self, table: str, value, regions=None, index=None, columns=None):
+        """Overrides the data of several regions at once
+
+        The selection (regions x index x columns) of the table of all the regions is stacked into a single dataframe
+        (see stack_reg_data), the new values are broadcast onto it in one vectorized operation and only the cells
+        whose value changed are written back into the regions. The changed cells are appended to the data_changes
+        attribute.
+
+        Parameters
+        ----------
+        table : str
+            Name of the table ('Demands', 'Resources', 'Technologies', 'Storage_power_to_energy' or 'Misc')
+        value : scalar, pd.Series or pd.DataFrame
+            New values. A scalar is set into all the selected cells.
+            A series or dataframe indexed by the regions is broadcast over the selected index
+            (and over the selected columns for a series).
+            A series or dataframe indexed by (regions, index) is aligned on the selection.
+            Missing values (NaN or regions/labels not in value) leave the data unchanged.
+        regions : list
+            Regions to update, by default all the regions
+        index : label or list
+            Rows of the table to update (e.g. technologies), by default all of them. Not used for Misc.
+        columns : label or list
+            Columns of the table (keys of Misc) to update, by default all of them
+
+        Returns
+        -------
+        Dataframe of the changed cells (Table, Regions, Index, Column, Old, New)
+
         """
-        TODO add doc
+        old = self.stack_reg_data(table=table, regions=regions, index=index, columns=columns)
+
+        # broadcast the new values on the selection
+        if isinstance(value, (pd.Series, pd.DataFrame)):
+            if value.index.nlevels == 1:
+                value = value.reindex(old.index.get_level_values(0))
+            else:
+                value = value.reindex(old.index)
+            if isinstance(value, pd.Series):
+                new = np.broadcast_to(value.values[:, None], old.shape)
+            else:
+                new = value.reindex(columns=old.columns).values
+        else:
+            new = np.broadcast_to(value, old.shape)
+        new = pd.DataFrame(new, index=old.index, columns=old.columns)
+        new = new.where(new.notna(), old)
+        changed = new.ne(old) & new.notna()
+
+        # log of the changed cells
+        rows, cols = np.nonzero(changed.values)
+        log = pd.DataFrame({'Table': table,
+                            'Regions': old.index.get_level_values(0)[rows],
+                            'Index': old.index.get_level_values(1)[rows] if old.index.nlevels > 1 else None,
+                            'Column': old.columns[cols],
+                            'Old': old.values[rows, cols],
+                            'New': new.values[rows, cols]})
+        if not log.empty:
+            self.data_changes = log if self.data_changes.empty \
+                else pd.concat([self.data_changes, log], axis=0, ignore_index=True)
+        logging.info('Updated ' + str(len(log)) + ' values of ' + table + ' in '
+                     + str(log['Regions'].nunique()) + ' regions')
+
+        # write back the changed cells into the regions, column by column
+        for j in np.flatnonzero(changed.values.any(axis=0)):
+            c = new.columns[j]
+            col = new.iloc[changed.values[:, j], j]
+            for r, v in col.groupby(level=0, sort=False):
+                if table == 'Misc':
+                    self.regions[r].data['Misc'][c] = v.iloc[0]
+                else:
+                    self.regions[r].data[table].loc[v.index.get_level_values(1), c] = v.values
+        return log
+
+    def drop_data(self, table: str, index, regions=None):
+        """Drops rows (e.g. technologies) from a table of several regions
+
+        Parameters
+        ----------
+        table : str
+            Name of the table ('Demands', 'Resources', 'Technologies' or 'Storage_power_to_energy')
+        index : label or list
+            Rows to drop
+        regions : list
+            Regions from which to drop the rows. By default, all the regions and the reference region
+            (from which the sets are built)
+
         """
-        # Logging
-        logging.info('Printing regional data into ' + str(self.cs_dir))
+        if regions is None:
+            regions = [self.ref_region] + [self.regions[r] for r in self.regions_names]
+        else:
+            regions = [self.regions[r] for r in regions]
+        for region in regions:
+            region.data[table] = region.data[table].drop(index=index)
+        return
 
-        # Concatenate data across regions
+    def update_data_reg(self):
+        """Concatenates the data of all the regions into the data_reg attribute (see concat_reg_data)"""
         self.data_reg['Demands'], self.data_reg['Resources'], \
             self.data_reg['Technologies'], self.data_reg['Storage_power_to_energy'], self.data_reg['Misc'] = \
             self.concat_reg_data(to_concat=['Demands', 'Resources', 'Technologies', 'Storage_power_to_energy', 'Misc'])
+        return
+
+    def get_rwithoutdam(self):
+        """Regions without hydro dam (f_max of HYDRO_DAM below 1e-2 in data_reg['Technologies'])"""
+        df = self.data_reg['Technologies'].loc[(slice(None), 'HYDRO_DAM'), 'f_max']
+        return list(df.loc[df < 1e-2].index.get_level_values(level=0))
+
+    def build_sets(self):
+        """Builds the sets of the ESOM from the data and stores them into the sets attribute"""
+        # demand related sets
+        self.sets['SECTORS'] = list(self.ref_region.data['Demands']
+                                    .drop(columns=['Category', 'Subcategory', 'Units']).columns)
+        self.sets['END_USES_INPUT'] = list(self.ref_region.data['Demands'].index)
+        self.sets['END_USES_CATEGORIES'] = list(self.data_indep['Misc_indep']['add_sets']['END_USES_CATEGORIES'].keys())
+        self.sets['END_USES_TYPES_OF_CATEGORY'] = self.data_indep['Misc_indep']['add_sets']['END_USES_CATEGORIES']
+        eut = list(self.sets['END_USES_TYPES_OF_CATEGORY'].values())
+        eut = [item for sublist in eut for item in sublist] # flatten list
+        # resources related sets
+        self.sets['RESOURCES'] = list(self.data_indep['Resources_indep'].index)
+        self.sets['RE_FUELS'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
+                                     .loc[:, 'Subcategory'] == 'Renewable fuel'].index)
+        self.sets['RE_RESOURCES'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
+                                     .loc[:, 'Category'] == 'Renewable'].index)
+        self.sets['EXPORT'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
+                                   .loc[:,'Category'] == 'Export'].index)
+        self.sets['NOT_LAYERS'] = self.data_indep['Misc_indep']['add_sets']['NOT_LAYERS']
+        self.sets['RES_IMPORT_CONSTANT'] = self.data_indep['Misc_indep']['add_sets']['RES_IMPORT_CONSTANT']
+        # exchanges related sets
+        self.sets['EXCHANGE_FREIGHT_R'] = self.data_reg['Exch']['Misc_exch']['add_sets']['EXCHANGE_FREIGHT_R']
+        self.sets['EXCHANGE_NETWORK_R'] = self.data_reg['Exch']['Misc_exch']['add_sets']['EXCHANGE_NETWORK_R']
+        self.sets['NETWORK_TYPE'] = self.data_reg['Exch']['Misc_exch']['add_sets']['NETWORK_TYPE']
+
+        # sorted, such that indep.dat (and its hash in the store of .dat files) does not depend on the hash seed
+        self.sets['NOEXCHANGES'] = sorted(set(self.sets['RESOURCES']) - set(self.sets['EXCHANGE_FREIGHT_R'])
+                                          - set(self.sets['EXCHANGE_NETWORK_R']))
+        # technologies related sets
+        all_techs = list(self.ref_region.data['Technologies'].index)
+        layers_in_out_tech = self.data_indep['Layers_in_out'].loc[~self.data_indep['Layers_in_out'].index.isin(self.sets['RESOURCES']), :]
+        self.sets['TECHNOLOGIES_OF_END_USES_TYPE'] = dict.fromkeys(eut)
+        for i in eut:
+            li = list(layers_in_out_tech.loc[layers_in_out_tech.loc[:, i] == 1, :].index)
+            self.sets['TECHNOLOGIES_OF_END_USES_TYPE'][i] = li
+
+        all_tech_of_eut = [item for sublist in list(self.sets['TECHNOLOGIES_OF_END_USES_TYPE'].values()) for item in sublist]
+
+        self.sets['STORAGE_TECH'] = list(self.data_indep['Storage_eff_in'].index)
+        self.sets['INFRASTRUCTURE'] = [item for item in all_techs
+                                       if item not in self.sets['STORAGE_TECH']
+                                       and item not in all_tech_of_eut]
+        self.sets['EVs_BATT'] = self.data_indep['Misc_indep']['add_sets']['EVs_BATT']
+        self.sets['V2G'] = self.data_indep['Misc_indep']['add_sets']['V2G']
+
+        self.sets['STORAGE_DAILY'] = self.data_indep['Misc_indep']['add_sets']['STORAGE_DAILY']
+        self.sets['STORAGE_OF_END_USES_TYPE'] = dict.fromkeys(eut)
+        for i in eut:
+            li = list(self.data_indep['Storage_eff_in'].loc[self.data_indep['Storage_eff_in'].loc[:, i] > 0, :].index)
+            self.sets['STORAGE_OF_END_USES_TYPE'][i] = li
+        self.sets['STORAGE_OF_END_USES_TYPE']\
+            = {k: v for k, v in self.sets['STORAGE_OF_END_USES_TYPE'].items() if v}  # Get rid of empty keys
+        dec_tech = self.sets['TECHNOLOGIES_OF_END_USES_TYPE']['HEAT_LOW_T_DECEN'].copy()
+        # TODO autmatise the thing about DEC_SOLAR?
+        dec_tech.remove('DEC_SOLAR')
+        ts_of_dec_tech = [['TS_' + item] for item in dec_tech]
+        self.sets['TS_OF_DEC_TECH'] = dict(zip(dec_tech, ts_of_dec_tech))
+        self.sets['EVs_BATT_OF_V2G'] = dict(zip(self.sets['V2G'], [[item] for item in self.sets['EVs_BATT']]))
+        self.sets['BOILERS'] = []
+        self.sets['COGEN'] = []
+        for i in all_tech_of_eut:
+            if 'BOILER' in i:
+                self.sets['BOILERS'].append(i)
+            if 'COGEN' in i:
+                self.sets['COGEN'].append(i)
+        return
+
+    def print_data(self, indep=False, wait=True, n_workers=None):
+        """Prints the regional data (and independent data if indep) into the .dat files of the case study
+
+        The .dat files are given by the store of .dat files of the spatial case study (see dat_print.DatStore):
+        a file is only printed if the data it is printed from differ from the ones of all the previous cases.
+        The files are printed concurrently in a pool of processes (see print_dat).
+
+        Parameters
+        ----------
+        indep : bool
+            Whether to print also indep.dat, the sets and the data independent of the regions
+        wait : bool
+            If True (default), waits until all the scheduled .dat files are printed (see wait_dat)
+        n_workers : int
+            Number of processes printing the .dat files if the pool is not started yet,
+            by default the number of cpus. Use n_workers=1 for a sequential printing.
+
+        """
+        # Logging
+        logging.info('Printing regional data into ' + str(self.cs_dir))
+
+        # Concatenate data across regions
+        self.update_data_reg()
 
         # Print demands, resources, technologies and storage power to energy
         for n in ['Demands', 'Resources', 'Technologies', 'Storage_power_to_energy']:
             df = self.data_reg[n].drop(columns=['Category', 'Subcategory', 'Technologies name', 'Units', 'Comment']
                                        , errors='ignore')
-            df = df.mask(df > 1e14, 'Infinity')
 
             if n == 'Demands':
                 name = 'param end_uses_demand_year : '
             else:
                 name = 'param : '
 
-            dp.print_df(df=dp.ampl_syntax(df),
-                        out_path=self.cs_dir / ('reg_' + n.lower() + '.dat'),
-                        name=name,
-                        mode='w')
+            self.print_dat(self.cs_dir / ('reg_' + n.lower() + '.dat'), sources=[df, name],
+                           write=partial(self.write_reg_dat, df=df, name=name), n_workers=n_workers)
 
         # Process and print misc data
 
         # Get set of regions without dam
-        df = self.data_reg['Technologies'].loc[(slice(None), 'HYDRO_DAM'), 'f_max']
-        rwithoutdam = list(df.loc[df < 1e-2].index.get_level_values(level=0))
+        rwithoutdam = self.get_rwithoutdam()
 
         # Print reg_misc.dat
-        misc_file = self.cs_dir / 'reg_misc.dat'
-
-        dp.print_header(dat_file=misc_file, header_txt='File containing miscellaneous sets and parameters')
-
-        dp.print_set(my_set=self.regions_names, out_path=misc_file, name='REGIONS')
-        dp.newline(out_path=misc_file)
-        dp.print_set(my_set=rwithoutdam, out_path=misc_file, name='RWITHOUTDAM', comment='# Regions without hydro dam')
-        dp.newline(out_path=misc_file)
-
-        dp.print_df(dp.ampl_syntax(self.data_reg['Misc']['share_ned']), out_path=misc_file, name='param share_ned :')
-
-        step = 4
-        for i in np.arange(0, self.data_reg['Misc']['misc'].shape[1], step):
-            df = self.data_reg['Misc']['misc'].iloc[:, i:i + step]  # select a subset of df
-            df = df.mask(df > 1e14, 'Infinity')  # replace high numbers by Infinity
-            dp.print_df(dp.ampl_syntax(df), out_path=misc_file, name='param :')
+        self.print_dat(self.cs_dir / 'reg_misc.dat', sources=[self.regions_names, rwithoutdam, self.data_reg['Misc']],
+                       write=partial(self.write_misc_dat, regions_names=self.regions_names, rwithoutdam=rwithoutdam,
+                                     misc=self.data_reg['Misc']),
+                       n_workers=n_workers)
 
         # Print reg_exch.dat
-        exch_file = self.cs_dir / 'reg_exch.dat'
-
-        dp.print_header(dat_file=exch_file, header_txt='File containing data related to exchanges between regions')
-
-        for n, d in self.data_reg['Exch'].items():
-            if n != 'Misc_exch':
-                dp.print_df(dp.ampl_syntax(d), out_path=exch_file, name='param : ')
-            else:
-                for n2, d2 in d.items():
-                    if type(d2) is dict:
-                        if n2 != 'add_sets':
-                            df = pd.DataFrame.from_dict(d2, orient='index', columns=[n2])
-                            name = 'param : '
-                            df = df.mask(df > 1e14, 'Infinity')
-                            dp.print_df(df=dp.ampl_syntax(df),
-                                        out_path=exch_file,
-                                        name=name,
-                                        mode='a')
-                            dp.newline(out_path=exch_file)
-                        else:
-                            pass
-                    else:
-                        if d2 > 1e14:
-                            d2 = 'Infinity'
-                        dp.print_param(param=d2, out_path=exch_file, name=n2)
-                        dp.newline(out_path=exch_file)
+        self.print_dat(self.cs_dir / 'reg_exch.dat', sources=[self.data_reg['Exch']],
+                       write=partial(self.write_exch_dat, exch=self.data_reg['Exch']), n_workers=n_workers)
 
         if indep:
             # Building SETS from data #
-            # demand related sets
-            self.sets['SECTORS'] = list(self.ref_region.data['Demands']
-                                        .drop(columns=['Category', 'Subcategory', 'Units']).columns)
-            self.sets['END_USES_INPUT'] = list(self.ref_region.data['Demands'].index)
-            self.sets['END_USES_CATEGORIES'] = list(self.data_indep['Misc_indep']['add_sets']['END_USES_CATEGORIES'].keys())
-            self.sets['END_USES_TYPES_OF_CATEGORY'] = self.data_indep['Misc_indep']['add_sets']['END_USES_CATEGORIES']
-            eut = list(self.sets['END_USES_TYPES_OF_CATEGORY'].values())
-            eut = [item for sublist in eut for item in sublist] # flatten list
-            # resources related sets
-            self.sets['RESOURCES'] = list(self.data_indep['Resources_indep'].index)
-            self.sets['RE_FUELS'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
-                                         .loc[:, 'Subcategory'] == 'Renewable fuel'].index)
-            self.sets['RE_RESOURCES'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
-                                         .loc[:, 'Category'] == 'Renewable'].index)
-            self.sets['EXPORT'] = list(self.data_indep['Resources_indep'][self.data_indep['Resources_indep']
-                                       .loc[:,'Category'] == 'Export'].index)
-            self.sets['NOT_LAYERS'] = self.data_indep['Misc_indep']['add_sets']['NOT_LAYERS']
-            self.sets['RES_IMPORT_CONSTANT'] = self.data_indep['Misc_indep']['add_sets']['RES_IMPORT_CONSTANT']
-            # exchanges related sets
-            self.sets['EXCHANGE_FREIGHT_R'] = self.data_reg['Exch']['Misc_exch']['add_sets']['EXCHANGE_FREIGHT_R']
-            self.sets['EXCHANGE_NETWORK_R'] = self.data_reg['Exch']['Misc_exch']['add_sets']['EXCHANGE_NETWORK_R']
-            self.sets['NETWORK_TYPE'] = self.data_reg['Exch']['Misc_exch']['add_sets']['NETWORK_TYPE']
-
-            self.sets['NOEXCHANGES'] = list(set(self.sets['RESOURCES']) - set(self.sets['EXCHANGE_FREIGHT_R'])
-                                                                             - set(self.sets['EXCHANGE_NETWORK_R']))
-            # technologies related sets
-            all_techs = list(self.ref_region.data['Technologies'].index)
-            layers_in_out_tech = self.data_indep['Layers_in_out'].loc[~self.data_indep['Layers_in_out'].index.isin(self.sets['RESOURCES']), :]
-            self.sets['TECHNOLOGIES_OF_END_USES_TYPE'] = dict.fromkeys(eut)
-            for i in eut:
-                li = list(layers_in_out_tech.loc[layers_in_out_tech.loc[:, i] == 1, :].index)
-                self.sets['TECHNOLOGIES_OF_END_USES_TYPE'][i] = li
-
-            all_tech_of_eut = [item for sublist in list(self.sets['TECHNOLOGIES_OF_END_USES_TYPE'].values()) for item in sublist]
-
-            self.sets['STORAGE_TECH'] = list(self.data_indep['Storage_eff_in'].index)
-            self.sets['INFRASTRUCTURE'] = [item for item in all_techs
-                                           if item not in self.sets['STORAGE_TECH']
-                                           and item not in all_tech_of_eut]
-            self.sets['EVs_BATT'] = self.data_indep['Misc_indep']['add_sets']['EVs_BATT']
-            self.sets['V2G'] = self.data_indep['Misc_indep']['add_sets']['V2G']
-
-            self.sets['STORAGE_DAILY'] = self.data_indep['Misc_indep']['add_sets']['STORAGE_DAILY']
-            self.sets['STORAGE_OF_END_USES_TYPE'] = dict.fromkeys(eut)
-            for i in eut:
-                li = list(self.data_indep['Storage_eff_in'].loc[self.data_indep['Storage_eff_in'].loc[:, i] > 0, :].index)
-                self.sets['STORAGE_OF_END_USES_TYPE'][i] = li
-            self.sets['STORAGE_OF_END_USES_TYPE']\
-                = {k: v for k, v in self.sets['STORAGE_OF_END_USES_TYPE'].items() if v}  # Get rid of empty keys
-            dec_tech = self.sets['TECHNOLOGIES_OF_END_USES_TYPE']['HEAT_LOW_T_DECEN'].copy()
-            # TODO autmatise the thing about DEC_SOLAR?
-            dec_tech.remove('DEC_SOLAR')
-            ts_of_dec_tech = [['TS_' + item] for item in dec_tech]
-            self.sets['TS_OF_DEC_TECH'] = dict(zip(dec_tech, ts_of_dec_tech))
-            self.sets['EVs_BATT_OF_V2G'] = dict(zip(self.sets['V2G'], [[item] for item in self.sets['EVs_BATT']]))
-            self.sets['BOILERS'] = []
-            self.sets['COGEN'] = []
-            for i in all_tech_of_eut:
-                if 'BOILER' in i:
-                    self.sets['BOILERS'].append(i)
-                if 'COGEN' in i:
-                    self.sets['COGEN'].append(i)
+            self.build_sets()
 
             # Printing indep.dat #
-            indep_file = self.cs_dir / 'indep.dat'
+            self.print_dat(self.cs_dir / 'indep.dat', sources=[self.sets, self.data_indep, self.period_duration],
+                           write=partial(self.write_indep_dat, sets=self.sets, data_indep=self.data_indep,
+                                         period_duration=self.period_duration),
+                           n_workers=n_workers)
+        if wait:
+            self.wait_dat()
+        return
+
+    @staticmethod
+    def write_reg_dat(path, df, name):
+        """Prints a table of the regional data into the .dat file path (see print_data)"""
+        with dp.DatWriter(path) as w:
+            w.print_df(df=dp.ampl_syntax(df.mask(df > 1e14, 'Infinity')), name=name)
+
+    @staticmethod
+    def write_misc_dat(path, regions_names, rwithoutdam, misc):
+        """Prints the miscellaneous sets and parameters of the regions into the .dat file path (see print_data)"""
+        with dp.DatWriter(path) as w:
+            w.print_header(header_txt='File containing miscellaneous sets and parameters')
+
+            w.print_set(my_set=regions_names, name='REGIONS')
+            w.newline()
+            w.print_set(my_set=rwithoutdam, name='RWITHOUTDAM', comment='# Regions without hydro dam')
+            w.newline()
+
+            w.print_df(dp.ampl_syntax(misc['share_ned']), name='param share_ned :')
+
+            step = 4
+            for i in np.arange(0, misc['misc'].shape[1], step):
+                df = misc['misc'].iloc[:, i:i + step]  # select a subset of df
+                df = df.mask(df > 1e14, 'Infinity')  # replace high numbers by Infinity
+                w.print_df(dp.ampl_syntax(df), name='param :')
+
+    @staticmethod
+    def write_exch_dat(path, exch):
+        """Prints the data related to exchanges between regions into the .dat file path (see print_data)"""
+        with dp.DatWriter(path) as w:
+            w.print_header(header_txt='File containing data related to exchanges between regions')
+
+            for n, d in exch.items():
+                if n != 'Misc_exch':
+                    w.print_df(dp.ampl_syntax(d), name='param : ')
+                else:
+                    for n2, d2 in d.items():
+                        if type(d2) is dict:
+                            if n2 != 'add_sets':
+                                df = pd.DataFrame.from_dict(d2, orient='index', columns=[n2])
+                                name = 'param : '
+                                df = df.mask(df > 1e14, 'Infinity')
+                                w.print_df(df=dp.ampl_syntax(df), name=name)
+                                w.newline()
+                            else:
+                                pass
+                        else:
+                            if d2 > 1e14:
+                                d2 = 'Infinity'
+                            w.print_param(param=d2, name=n2)
+                            w.newline()
+
+    @staticmethod
+    def write_indep_dat(path, sets, data_indep, period_duration):
+        """Prints the sets and the data independent of the regions into the .dat file path (see print_data)"""
+        with dp.DatWriter(path) as w:
             # Header
-            dp.print_header(dat_file=indep_file,
-                            header_txt='File containing data independent of the modelled regions')
+            w.print_header(header_txt='File containing data independent of the modelled regions')
             # Sets
-            dp.newline(out_path=indep_file, comment=['#----------------------------------------',
-                                                     '# SETS not depending on TD, nor on REGIONS',
-                                                     '#----------------------------------------'])
-            for n,s in self.sets.items():
+            w.newline(comment=['#----------------------------------------',
+                               '# SETS not depending on TD, nor on REGIONS',
+                               '#----------------------------------------'])
+            for n,s in sets.items():
                 if type(s) is list:
-                    dp.print_set(my_set=s, out_path=indep_file, name=n)
+                    w.print_set(my_set=s, name=n)
                 else:
                     for n2,s2 in s.items():
-                        dp.print_set(my_set=s2, out_path=indep_file, name=(n + '["' + n2 + '"]'))
+                        w.print_set(my_set=s2, name=(n + '["' + n2 + '"]'))
             # Parameters
-            dp.newline(out_path=indep_file, comment=['',
-                                                     '#----------------------------------------',
-                                                     '# PARAMETERS NOT DEPENDING ON THE NUMBER OF TYPICAL DAYS, '
-                                                     'NOR ON THE REGIONS :',
-                                                     '#----------------------------------------'])
+            w.newline(comment=['',
+                               '#----------------------------------------',
+                               '# PARAMETERS NOT DEPENDING ON THE NUMBER OF TYPICAL DAYS, '
+                               'NOR ON THE REGIONS :',
+                               '#----------------------------------------'])
             # TODO is it possible to bettter automatise this?
-            for n,d in self.data_indep.items():
+            for n,d in data_indep.items():
                 if n != 'Misc_indep':
                     df = d.drop(
                         columns=['Category', 'Subcategory', 'Technologies name', 'Units', 'Comment']
@@ -473,99 +737,120 @@ class Esmc:
                     else:
                         name = 'param : '
 
-                    dp.print_df(df=dp.ampl_syntax(df),
-                                out_path=indep_file,
-                                name=name,
-                                mode='a')
-                    dp.newline(out_path=indep_file)
+                    w.print_df(df=dp.ampl_syntax(df), name=name)
+                    w.newline()
                 else:
                     for n2,d2 in d.items():
                         if type(d2) is dict:
                             if n2 != 'add_sets' and n2 != 'time_series_mapping':
                                 if n2 == 'state_of_charge_ev':
                                     df = pd.DataFrame.from_dict(d2, orient='index', columns=np.arange(1,25))
+                                    if period_duration != 1:
+                                        # the minimum state of charge of a period is the highest one of its hours
+                                        df = df.T.groupby((df.columns - 1) // period_duration + 1).max().T
                                     name = 'param state_of_charge_ev : '
                                 else:
                                     df = pd.DataFrame.from_dict(d2,orient='index', columns=[n2])
                                     name = 'param : '
 
                                 df = df.mask(df > 1e14, 'Infinity')
-                                dp.print_df(df=dp.ampl_syntax(df),
-                                            out_path=indep_file,
-                                            name=name,
-                                            mode='a')
-                                dp.newline(out_path=indep_file)
+                                w.print_df(df=dp.ampl_syntax(df), name=name)
+                                w.newline()
                             else:
                                 pass
 
                         else:
                             if d2 > 1e14:
                                 d2 = 'Infinity'
-                            dp.print_param(param=d2, out_path=indep_file, name=n2)
-                            dp.newline(out_path=indep_file)
-        return
+                            w.print_param(param=d2, name=n2)
+                            w.newline()
+
+    def print_dat(self, dat_file: Path, sources: list, write, n_workers=None):
+        """Schedules the printing of a .dat file (see dat_print.DatStore.print_dat) in the pool of processes
+
+        The .dat files do not depend on each other, they are thus formatted and written concurrently
+        by worker processes, the printing of the largest one bounding the total printing time.
+        The job is pickled when scheduled: the data can be modified afterwards without affecting the printed file.
+        The processes are forked from the current one. Where forking is not available (e.g. on Windows, where
+        starting a process runs the calling script again) or with a single worker, the file is printed at once.
+
+        Parameters
+        ----------
+        dat_file : pathlib.Path
+            Path to the .dat file of the case study
+        sources : list
+            Sources from which the .dat file is printed
+        write : callable
+            Picklable function (e.g. partial of a static method) printing the .dat file into the path given as argument
+        n_workers : int
+            Number of processes of the pool if it is not started yet, by default the number of cpus
 
-    def print_td_data(self, eud_params=None, res_params=None, res_mult_params=None):
         """
+        if self.dat_pool is None:
+            if n_workers is None:
+                n_workers = os.cpu_count() or 1
+            if n_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+                self.dat_store.print_dat(dat_file, sources, write)
+                return
+            self.dat_pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork'))
+        self.dat_jobs.append(self.dat_pool.submit(self.dat_store.print_dat, dat_file, sources, write))
+        return
 
+    def wait_dat(self):
+        """Waits until all the .dat files scheduled by print_data and print_td_data are printed
 
-        Returns
-        -------
+        Raises the first exception raised while printing them, if any.
+        Then, removes the files of the store of .dat files not linked anymore by any case study (see DatStore.clean).
 
         """
+        if self.dat_pool is not None:
+            jobs, self.dat_jobs = self.dat_jobs, list()
+            pool, self.dat_pool = self.dat_pool, None
+            try:
+                for j in jobs:
+                    j.result()
+            finally:
+                pool.shutdown(wait=True)
+        self.dat_store.clean()
+        return
 
-        # file to print to
-        dat_file = self.cs_dir / ('reg_' + str(self.nbr_td) + 'TD.dat')
+    def compute_td_data(self, eud_params=None, res_params=None, res_mult_params=None):
+        """Computes the data of the ESOM depending on the typical days (TDs)
 
-        # logging info
-        logging.info('Printing TD data into ' + str(dat_file))
+        The result is also kept into the attribute td_data, such that push_td_data can reuse the data
+        computed by print_td_data instead of rescaling the time series of the TDs again.
 
-        # PRELIMINARY COMPUTATIONS
+        Parameters
+        ----------
+        eud_params : dict
+            Names of the parameters of the end-uses demands time series (by default from Misc_indep)
+        res_params : dict
+            Names of the technologies of the resources time series linked to 1 technology
+        res_mult_params : dict
+            Names of the technologies of the resources time series linked to several technologies
+
+        Returns
+        -------
+        Dictionary with
+            t_h_td: dataframe of the (H_of_Y, H_of_D, TD_number) tuples of the set T_H_TD
+            peak_sh_factor and peak_sc_factor: dataframes indexed by the regions
+            regions, periods, td_numbers: labels of the regions, periods of the day and TDs
+            eud_ts: dict of the arrays (N_regions x N_periods x Nbr_TD) of each end-use demand time series parameter
+            c_p_t_techs and c_p_t: technologies and array (N_techs x N_regions x N_periods x Nbr_TD) of c_p_t
+
+        """
         # From temporal aggregation results (td_of_days): generate t_h_td and td_count
         # and compute rescaled typical days ts and peak_sh_factor for each region
         self.ta.generate_t_h_td()
+        self.ta.rescale_td_ts()
         peak_sh_factor = pd.DataFrame(0.0, index=self.regions_names, columns=['peak_sh_factor'])
         peak_sc_factor = pd.DataFrame(0.0, index=self.regions_names, columns=['peak_sc_factor'])
         for r in self.regions:
-            self.regions[r].rescale_td_ts(self.ta.td_count)
-            self.regions[r].compute_peak_sh_and_sc()
+            self.regions[r].compute_peak_sh_and_sc(period_duration=self.period_duration)
             peak_sh_factor.loc[r, 'peak_sh_factor'] = self.regions[r].peak_sh_factor
             peak_sc_factor.loc[r, 'peak_sc_factor'] = self.regions[r].peak_sc_factor
 
-        t_h_td = self.ta.t_h_td.copy()
-        t_h_td['par_l'] = '('
-        t_h_td['par_r'] = ')'
-        t_h_td['comma1'] = ','
-        t_h_td['comma2'] = ','
-        t_h_td = t_h_td[['par_l', 'H_of_Y', 'comma1', 'H_of_D', 'comma2', 'TD_number', 'par_r']]  # reordering columns
-
-        # PRINTING
-        # printing signature of data file
-        dp.print_header(dat_file=dat_file
-                        , header_file=self.project_dir / 'esmc' / 'energy_model' / 'headers' / 'header_td_data.txt'
-                        )
-
-        # printing set depending on TD
-
-        # printing set TYPICAL_DAYS -> replaced by printing param nbr_tds
-        # dp.print_set(my_set=[str(i) for i in np.arange(1, self.Nbr_TD + 1)],out_path=dat_file,name='TYPICAL_DAYS',
-        # comment='# typical days')
-        # printing set T_H_TD
-        dp.newline(dat_file, ['set T_H_TD := 		'])
-        t_h_td.to_csv(dat_file, sep=AMPL_SEPARATOR, header=False, index=False, mode='a', quoting=csv.QUOTE_NONE)
-        dp.end_table(dat_file)
-        # printing parameters depending on TD
-        # printing interlude
-        dp.newline(dat_file, ['# -----------------------------', '# PARAMETERS DEPENDING ON NUMBER OF TYPICAL DAYS : ',
-                              '# -----------------------------', ''])
-        # printing nbr_tds
-        dp.print_param(param=self.nbr_td, out_path=dat_file, name='nbr_tds')
-        # printing peak_sh_factor and peak_sc_factor
-        dp.print_df(df=dp.ampl_syntax(peak_sh_factor), out_path=dat_file, name='param ')
-        dp.print_df(df=dp.ampl_syntax(peak_sc_factor), out_path=dat_file, name='param ')
-
         # TODO automise this
-
         # Default name of timeseries in DATA.xlsx and corresponding name in ESTD data file
         if eud_params is None:
             # # for EUD timeseries
@@ -588,47 +873,290 @@ class Esmc:
             # res_mult_params = {'TIDAL': ['TIDAL_STREAM', 'TIDAL_RANGE'],
             #                    'SOLAR': ['DHN_SOLAR', 'DEC_SOLAR', 'PT_COLLECTOR', 'ST_COLLECTOR', 'STIRLING_DISH']}
 
-        # printing EUD timeseries param
-        for i in eud_params.keys():
-            dp.newline(out_path=dat_file, comment=['param ' + eud_params[i] + ' :='])
-            for r in self.regions:
-                # select the (24xNbr_TD) dataframe of region r and time series l, drop the level of index with the
-                # name of the time series, put it into ampl syntax and print it
-                dp.print_df(df=dp.ampl_syntax(self.regions[r].ts_td.loc[(i, slice(None)), :].droplevel(level=0)),
-                            out_path=dat_file,
-                            name='["' + r + '",*,*] : ', end_table=False)
-            dp.end_table(out_path=dat_file)
-
-        # printing c_p_t param #
-        dp.newline(out_path=dat_file, comment=['param c_p_t:='])
-        # printing c_p_t part where 1 ts => 1 tech
-        for i in res_params.keys():
-            for r in self.regions:
-                # select the (24xNbr_TD) dataframe of region r and time series l, drop the level of index with the
-                # name of the time series, put it into ampl syntax and print it
-                dp.print_df(df=dp.ampl_syntax(self.regions[r].ts_td.loc[(i, slice(None)), :].droplevel(level=0)),
-                            out_path=dat_file,
-                            name='["' + res_params[i] + '","' + r + '",*,*] :', end_table=False)
-
-        # printing c_p_t part where 1 ts => more than 1 tech
-        for i in res_mult_params.keys():
-            for j in res_mult_params[i]:
-                for r in self.regions:
-                    # select the (24xNbr_TD) dataframe of region r and time series l, drop the level of index
-                    # with the name of the time series, put it into ampl syntax and print it
-                    dp.print_df(
-                        df=dp.ampl_syntax(self.regions[r].ts_td.loc[(i, slice(None)), :].droplevel(level=0)),
-                        out_path=dat_file, name='["' + j + '","' + r + '",*,*] :', end_table=False)
-
-        dp.end_table(out_path=dat_file)
+        # the TD time series of all the regions are stacked into (time series x regions x periods x TDs) arrays
+        regions = list(self.regions.keys())
+        # with periods of several hours, the shares of the yearly demand are summed over each period
+        eud_ts = self.ta.aggregate_periods_array(self.stack_td_ts(list(eud_params.keys())), how='sum')
+        # c_p_t of each tech, the techs of res_mult_params sharing the same ts
+        # with periods of several hours, the capacity factors are averaged over each period
+        techs = list(res_params.values()) + [j for i in res_mult_params.keys() for j in res_mult_params[i]]
+        ts_of_techs = list(res_params.keys()) + [i for i in res_mult_params.keys() for j in res_mult_params[i]]
+        c_p_t = self.ta.aggregate_periods_array(self.stack_td_ts(ts_of_techs), how='mean')
+
+        self.td_data = {'t_h_td': self.ta.t_h_td[['H_of_Y', 'H_of_D', 'TD_number']],
+                        'peak_sh_factor': peak_sh_factor, 'peak_sc_factor': peak_sc_factor,
+                        'regions': regions, 'periods': np.arange(1, 24 // self.period_duration + 1),
+                        'td_numbers': list(self.regions[regions[0]].ts_td.columns),
+                        'eud_ts': {eud_params[i]: eud_ts[k] for k, i in enumerate(eud_params.keys())},
+                        'c_p_t_techs': techs, 'c_p_t': c_p_t}
+        return self.td_data
+
+    def print_td_data(self, eud_params=None, res_params=None, res_mult_params=None, wait=True, n_workers=None):
+        """Prints the data depending on the typical days into reg_<nbr_td>TD.dat (see compute_td_data)
+
+        The file is given by the store of .dat files of the spatial case study (see dat_print.DatStore)
+        and printed in the pool of processes (see print_dat). With wait=False, it is printed while
+        the next steps run (e.g. print_data, which waits for all the scheduled .dat files by default).
+
+        Parameters
+        ----------
+        eud_params, res_params, res_mult_params : dict
+            Names of the parameters of the time series (see compute_td_data)
+        wait : bool
+            If True (default), waits until all the scheduled .dat files are printed (see wait_dat)
+        n_workers : int
+            Number of processes printing the .dat files if the pool is not started yet (see print_data)
+
+        """
+
+        # file to print to
+        dat_file = self.cs_dir / ('reg_' + str(self.nbr_td) + 'TD.dat')
+
+        # logging info
+        logging.info('Printing TD data into ' + str(dat_file))
+
+        # PRELIMINARY COMPUTATIONS
+        td_data = self.compute_td_data(eud_params=eud_params, res_params=res_params, res_mult_params=res_mult_params)
+
+        # PRINTING
+        header_file = self.project_dir / 'esmc' / 'energy_model' / 'headers' / 'header_td_data.txt'
+
+        # the file is only printed if the TD data differ from the ones of all the previous cases
+        self.print_dat(dat_file, sources=[header_file.read_text(), self.nbr_td, self.period_duration, td_data],
+                       write=partial(self.write_td_dat, header_file=header_file, nbr_td=self.nbr_td,
+                                     period_duration=self.period_duration, td_data=td_data),
+                       n_workers=n_workers)
+        if wait:
+            self.wait_dat()
         return
 
-    def set_esom(self, ref_dir=None, ampl_options=None, copy_from_ref=True, solver='cplex', ampl_path=None, mod_path=list()):
+    @staticmethod
+    def write_td_dat(path, header_file, nbr_td, period_duration, td_data):
+        """Prints the data depending on the typical days into the .dat file path (see print_td_data)"""
+        t_h_td = td_data['t_h_td'].copy()
+        t_h_td['par_l'] = '('
+        t_h_td['par_r'] = ')'
+        t_h_td['comma1'] = ','
+        t_h_td['comma2'] = ','
+        t_h_td = t_h_td[['par_l', 'H_of_Y', 'comma1', 'H_of_D', 'comma2', 'TD_number', 'par_r']]  # reordering columns
+
+        with dp.DatWriter(path) as w:
+            # printing signature of data file
+            w.print_header(header_file=header_file)
+
+            # printing set depending on TD
+
+            # printing set TYPICAL_DAYS -> replaced by printing param nbr_tds
+            # w.print_set(my_set=[str(i) for i in np.arange(1, self.Nbr_TD + 1)], name='TYPICAL_DAYS',
+            # comment='# typical days')
+            # printing set T_H_TD
+            w.newline(['set T_H_TD := 		'])
+            w.to_csv(t_h_td, sep=AMPL_SEPARATOR, header=False, index=False, quoting=csv.QUOTE_NONE)
+            w.end_table()
+            # printing parameters depending on TD
+            # printing interlude
+            w.newline(['# -----------------------------', '# PARAMETERS DEPENDING ON NUMBER OF TYPICAL DAYS : ',
+                       '# -----------------------------', ''])
+            # printing nbr_tds
+            w.print_param(param=nbr_td, name='nbr_tds')
+            if period_duration != 1:
+                # printing the duration of the periods (t_op), 1 by default
+                w.print_param(param=period_duration, name='period_duration')
+            # printing peak_sh_factor and peak_sc_factor
+            w.print_df(df=dp.ampl_syntax(td_data['peak_sh_factor']), name='param ')
+            w.print_df(df=dp.ampl_syntax(td_data['peak_sc_factor']), name='param ')
+
+            # each parameter is printed with a single formatting of the tables of all the regions
+            regions = td_data['regions']
+            index = td_data['periods']
+            columns = td_data['td_numbers']
+
+            # printing EUD timeseries param
+            for name, a in td_data['eud_ts'].items():
+                w.newline(comment=['param ' + name + ' :='])
+                w.print_tables(a, names=['["' + r + '",*,*] : ' for r in regions], index=index, columns=columns)
+                w.end_table()
+
+            # printing c_p_t param #
+            w.newline(comment=['param c_p_t:='])
+            c_p_t = td_data['c_p_t']
+            w.print_tables(c_p_t.reshape((-1,) + c_p_t.shape[2:]),
+                           names=['["' + j + '","' + r + '",*,*] :' for j in td_data['c_p_t_techs'] for r in regions],
+                           index=index, columns=columns)
+            w.end_table()
+
+    def stack_td_ts(self, ts_names: list):
+        """Stacks the rescaled time series of the typical days of all the regions
+
+        Parameters
+        ----------
+        ts_names : list
+            Names of the time series to stack (can be repeated)
+
+        Returns
+        -------
+        Array of shape (len(ts_names) x N_regions x 24 x Nbr_TD), the regions being in the order of self.regions
+
+        """
+        out = list()
+        for r, region in self.regions.items():
+            names = region.ts_td.index.unique(level=0)
+            idx = names.get_indexer(ts_names)
+            if (idx < 0).any():
+                raise KeyError('Time series ' + str([t for t, i in zip(ts_names, idx) if i < 0])
+                               + ' not in the typical days of ' + r)
+            out.append(region.ts_td.values.reshape(len(names), 24, -1)[idx])
+        return np.stack(out, axis=1)
+
+    @staticmethod
+    def to_ampl(df):
+        """Drops the description columns of df and gives its high numbers (above 1e14) as infinity"""
+        df = df.drop(columns=['Category', 'Subcategory', 'Technologies name', 'Units', 'Comment'], errors='ignore')
+        return df.mask(df > 1e14, np.inf)
+
+    def push_indep_data(self):
+        """Assigns the sets and the data independent of the regions directly to the ampl object of the esom
+
+        The same data as printed by print_data into indep.dat are given to ampl, in the same order,
+        without formatting and parsing the .dat file.
+        The esom must have been set with set_esom(dat_files=False).
+
+        """
+        logging.info('Pushing indep data into ampl')
+        esom = self.esom
+
+        # sets
+        self.build_sets()
+        for n, s in self.sets.items():
+            esom.set_set(n, s)
+
+        # parameters
+        for n, d in self.data_indep.items():
+            if n != 'Misc_indep':
+                if n in ['Layers_in_out', 'Storage_eff_in', 'Storage_eff_out']:
+                    # tables of 1 parameter indexed by (row, column)
+                    esom.set_param(n.lower(), self.to_ampl(d).stack())
+                else:
+                    esom.set_params(self.to_ampl(d))
+            else:
+                for n2, d2 in d.items():
+                    if type(d2) is dict:
+                        if n2 == 'state_of_charge_ev':
+                            df = pd.DataFrame.from_dict(d2, orient='index', columns=np.arange(1, 25))
+                            if self.period_duration != 1:
+                                # the minimum state of charge of a period is the highest one of its hours
+                                df = df.T.groupby((df.columns - 1) // self.period_duration + 1).max().T
+                            esom.set_param(n2, self.to_ampl(df).stack())
+                        elif n2 != 'add_sets' and n2 != 'time_series_mapping':
+                            esom.set_param(n2, self.to_ampl(pd.Series(d2)))
+                    else:
+                        esom.set_param(n2, np.inf if d2 > 1e14 else d2)
+        return
+
+    def push_data(self, indep=False):
+        """Assigns the regional data (and independent data if indep) directly to the ampl object of the esom
+
+        The same data as printed by print_data are given to ampl as sets and parameters,
+        in the order in which set_esom reads the .dat files (indep.dat if indep, then reg_demands.dat, reg_exch.dat,
+        reg_misc.dat, reg_resources.dat, reg_storage_power_to_energy.dat and reg_technologies.dat),
+        without formatting and parsing them.
+        The esom must have been set with set_esom(dat_files=False).
+
+        Parameters
+        ----------
+        indep : bool
+            Whether to assign also the data independent of the regions and the sets built from them
+            (see push_indep_data)
+
+        """
+        if indep:
+            self.push_indep_data()
+
+        logging.info('Pushing regional data into ampl')
+        esom = self.esom
+        self.update_data_reg()
+
+        # demands
+        esom.set_param('end_uses_demand_year', self.to_ampl(self.data_reg['Demands']).stack())
+
+        # exchanges data
+        for n, d in self.data_reg['Exch'].items():
+            if n != 'Misc_exch':
+                esom.set_params(d)
+            else:
+                for n2, d2 in d.items():
+                    if type(d2) is dict:
+                        if n2 != 'add_sets':
+                            esom.set_param(n2, self.to_ampl(pd.Series(d2)))
+                    else:
+                        esom.set_param(n2, np.inf if d2 > 1e14 else d2)
+
+        # misc data
+        esom.set_set('REGIONS', self.regions_names)
+        esom.set_set('RWITHOUTDAM', self.get_rwithoutdam())
+        esom.set_param('share_ned', self.data_reg['Misc']['share_ned'].stack())
+        esom.set_params(self.to_ampl(self.data_reg['Misc']['misc']))
+
+        # resources, storage power to energy and technologies
+        for n in ['Resources', 'Storage_power_to_energy', 'Technologies']:
+            esom.set_params(self.to_ampl(self.data_reg[n]))
+        return
+
+    def push_td_data(self, eud_params=None, res_params=None, res_mult_params=None):
+        """Assigns the data depending on the typical days directly to the ampl object of the esom
+
+        The same data as printed by print_td_data (see compute_td_data) are given to ampl as sets and parameters,
+        without formatting and parsing the reg_<nbr_td>TD.dat file.
+        Without parameters, the data computed by the last call of print_td_data (or compute_td_data) since init_ta
+        are reused, with the parameters given to it. Otherwise, or if there are none, they are computed.
+        The esom must have been set with set_esom(dat_files=False).
+
+        Parameters
+        ----------
+        eud_params, res_params, res_mult_params : dict
+            Names of the parameters of the time series (see compute_td_data)
+
+        """
+        logging.info('Pushing TD data into ampl')
+        esom = self.esom
+        if self.td_data is None or any(p is not None for p in [eud_params, res_params, res_mult_params]):
+            self.compute_td_data(eud_params=eud_params, res_params=res_params, res_mult_params=res_mult_params)
+        td_data = self.td_data
+
+        # the scalar parameters first, as they define the sets TYPICAL_DAYS, PERIODS and HOURS containing T_H_TD
+        esom.set_param('nbr_tds', self.nbr_td)
+        esom.set_param('period_duration', self.period_duration)
+        esom.set_set('T_H_TD', [tuple(t) for t in td_data['t_h_td'].values.tolist()])
+        esom.set_params(td_data['peak_sh_factor'])
+        esom.set_params(td_data['peak_sc_factor'])
+
+        # time series indexed by (REGIONS, HOURS, TYPICAL_DAYS)
+        index = pd.MultiIndex.from_product([td_data['regions'], td_data['periods'].tolist(), td_data['td_numbers']])
+        for name, a in td_data['eud_ts'].items():
+            esom.set_param(name, pd.Series(a.ravel(), index=index))
+        # c_p_t indexed by (TECHNOLOGIES, REGIONS, HOURS, TYPICAL_DAYS)
+        index = pd.MultiIndex.from_product([td_data['c_p_t_techs'], td_data['regions'],
+                                            td_data['periods'].tolist(), td_data['td_numbers']])
+        esom.set_param('c_p_t', pd.Series(td_data['c_p_t'].ravel(), index=index))
+        return
+
+    def set_esom(self, ref_dir=None, ampl_options=None, copy_from_ref=True, solver='cplex', ampl_path=None, mod_path=list(),
+                 dat_files=True):
         """
 
         Set the energy system optimisation model (esom) with the mod and dat files from ref_dir that are copied into the
 
+        Parameters
+        ----------
+        dat_files : bool
+            If True (default), ampl reads the data from the .dat files printed by print_data and print_td_data.
+            If False, the same data are assigned directly from memory to ampl (see push_indep_data, push_td_data and
+            push_data), the TD data being the ones computed by print_td_data, and the .dat files are only needed
+            for archiving.
+
         """
+        # the .dat files scheduled by print_data and print_td_data must be printed before being read
+        self.wait_dat()
 
         if len(mod_path) == 0:
             # path where to copy them for this case study
@@ -683,8 +1211,15 @@ class Esmc:
 
         # set ampl for step_2
         logging.info('Setting esom into ' + str(self.cs_dir))
+        if not dat_files:
+            data_path = list()
         self.esom = OptiProbl(mod_path=mod_path, data_path=data_path, options=ampl_options, solver=solver,
                               ampl_path=ampl_path)
+        if not dat_files:
+            # assign the data from memory instead of reading the .dat files, in the order of data_path
+            self.push_indep_data()
+            self.push_td_data()
+            self.push_data()
 
         # deactivate some unused constraints
         if self.gwp_limit_overall is None:
@@ -877,7 +1412,7 @@ class Esmc:
         # create frames for concatenation (list of df to concat)
         frames = list()
         for n, r in self.regions.items():
-            frames.append(r.data['Technologies'].loc[:, 'lifetime'].copy())
+            frames.append(r.data.view('Technologies').loc[:, 'lifetime'].copy())
         lifetime = pd.concat(frames, axis=0, keys=self.regions_names)
 
         # annualize GWP_constr by dividing by lifetime
@@ -928,11 +1463,11 @@ class Esmc:
 
         # Get results related to Resources and Exchanges and sum over all layers
         # year local production and import from exterior
-        r_year_local = self.ta.from_td_to_year(ts_td=r_t_local.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Resources']).sum().rename(columns={'R_t_local': 'R_year_local'})
-        r_year_exterior = self.ta.from_td_to_year(ts_td=r_t_exterior
-                                                  .reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Resources']).sum().rename(columns={'R_t_exterior': 'R_year_exterior'})
+        r_year_local = self.ta.year_total(ts_td=r_t_local.reset_index().set_index(['Typical_days', 'Hours']),
+                                          by=['Regions', 'Resources']).rename(columns={'R_t_local': 'R_year_local'})
+        r_year_exterior = self.ta.year_total(ts_td=r_t_exterior.reset_index().set_index(['Typical_days', 'Hours']),
+                                             by=['Regions', 'Resources'])\
+            .rename(columns={'R_t_exterior': 'R_year_exterior'})
 
         # get exchanges over the year for r_exch
         exch_imp = self.esom.get_var('Exch_imp').loc[(slice(None), slice(None), r_exch, slice(None), slice(None)), :]
@@ -967,8 +1502,8 @@ class Esmc:
         exch['Balance'] = exch['Balance'].mask((exch['Balance'].abs() < threshold), np.nan)
 
         # compute total over the year for each LINK
-        exchanges_year = self.ta.from_td_to_year(ts_td=exch.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['From', 'To', 'Resources']).sum().drop(columns=['Balance'])
+        exchanges_year = self.ta.year_total(ts_td=exch.reset_index().set_index(['Typical_days', 'Hours']),
+                                            by=['From', 'To', 'Resources']).drop(columns=['Balance'])
         # compute total over the year for each REGION
         r_exch_region = exchanges_year.groupby(['From', 'Resources']).sum().abs()
 
@@ -999,8 +1534,8 @@ class Esmc:
         r_t['Balance'] = r_t['Balance'].mask(r_t['Balance'] < 0, 0)
         # sum over all regions and all hours to get total fluxes
         r_t = r_t.groupby(['Resources', 'Hours', 'Typical_days']).sum()
-        exchanges_year_all = self.ta.from_td_to_year(ts_td=r_t.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Resources']).sum()
+        exchanges_year_all = self.ta.year_total(ts_td=r_t.reset_index().set_index(['Typical_days', 'Hours']),
+                                                by=['Resources'])
         exchanges_year_all = exchanges_year_all.drop(columns=['Exch_exp', 'Exch_imp'])\
             .rename(columns={'Balance': 'Exchanges_year'})
 
@@ -1014,7 +1549,7 @@ class Esmc:
         # create frames for concatenation (list of df to concat)
         frames = list()
         for n, r in self.regions.items():
-            frames.append(r.data['Resources'].loc[:, ['avail_local', 'avail_exterior']].copy())
+            frames.append(r.data.view('Resources').loc[:, ['avail_local', 'avail_exterior']].copy())
         resources = pd.concat(frames, axis=0, keys=self.regions_names)
         resources.index.set_names(r_year_local.index.names, inplace=True)  # set proper name to index
         # merge availabilities with uses of Resources
@@ -1100,8 +1635,8 @@ class Esmc:
         f = self.esom.get_var('F')
         # energy produced by the technology
         f_t = self.esom.get_var('F_t')
-        f_year = self.ta.from_td_to_year(ts_td=f_t.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Technologies']).sum() \
+        f_year = self.ta.year_total(ts_td=f_t.reset_index().set_index(['Typical_days', 'Hours']),
+                                    by=['Regions', 'Technologies']) \
             .rename(columns={'F_t': 'F_year'})
         # Get Storage_power (power balance at each hour)
         storage_in = self.esom.get_var('Storage_in') \
@@ -1114,7 +1649,7 @@ class Esmc:
         # create frames for concatenation (list of df to concat)
         frames = list()
         for n, r in self.regions.items():
-            frames.append(r.data['Technologies'].loc[:, ['f_min', 'f_max']].copy())
+            frames.append(r.data.view('Technologies').loc[:, ['f_min', 'f_max']].copy())
         assets = f.merge(pd.concat(frames, axis=0, keys=self.regions_names)
                          , left_on=['Regions', 'Technologies'], right_index=True) \
             .merge(f_year, left_on=['Regions', 'Technologies'], right_on=['Regions', 'Technologies']).reset_index()
@@ -1135,9 +1670,9 @@ class Esmc:
         storage_power['Storage_power'] = storage_power['Storage_out'] + storage_power['Storage_in']
         storage_power.index.rename(['Regions', 'Storage_tech', 'Hours', 'Typical_days'], inplace=True)
         # losses are the sum of the balance over the year
-        sto_losses = self.ta.from_td_to_year(ts_td=storage_power['Storage_power']
-                                             .reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Storage_tech']).sum()
+        sto_losses = self.ta.year_total(ts_td=storage_power['Storage_power']
+                                        .reset_index().set_index(['Typical_days', 'Hours']),
+                                        by=['Regions', 'Storage_tech'])
         # Update F_year in assets df for STORAGE_TECH
         assets.loc[sto_losses.index, 'F_year'] = sto_losses['Storage_power']
         # replace Storage_in and Storage_out by values deduced from Storage_power
@@ -1147,9 +1682,9 @@ class Esmc:
                                                                           np.nan)
         storage_power['Storage_out'] = storage_power['Storage_power'].mask((storage_power['Storage_power'] < threshold),
                                                                            np.nan)
-        # Compute total over the year by mapping TD
-        sto_flux_year = self.ta.from_td_to_year(ts_td=storage_power.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Storage_tech']).sum() \
+        # Compute total over the year by weighting each TD by the number of days it represents
+        sto_flux_year = self.ta.year_total(ts_td=storage_power.reset_index().set_index(['Typical_days', 'Hours']),
+                                           by=['Regions', 'Storage_tech']) \
             .rename(columns={'Storage_out': 'Year_energy_flux'}).drop(columns=['Storage_in', 'Storage_power'])
         # create sto_assets from copy() of assets
         sto_assets = assets.copy()
@@ -1162,7 +1697,7 @@ class Esmc:
         # and compute maximum input and output power of the storage technology
         frames = list()
         for n, r in self.regions.items():
-            frames.append(r.data['Storage_power_to_energy'].copy())
+            frames.append(r.data.view('Storage_power_to_energy').copy())
         sto_assets = sto_assets.merge(pd.concat(frames, axis=0, keys=self.regions_names)
                                       , left_on=['Regions', 'Technologies'], right_index=True)
         sto_assets['Storage_in_max'] = sto_assets['F'] / sto_assets['storage_charge_time']
@@ -1200,9 +1735,9 @@ class Esmc:
         logging.info('Getting Year_balance')
 
         # EXTRACT RESULTS FROM OPTIMISATION MODEL
-        end_uses = -self.ta.from_td_to_year(ts_td=self.esom.get_var('End_uses')
-                                            .reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Layers']).sum()
+        end_uses = -self.ta.year_total(ts_td=self.esom.get_var('End_uses')
+                                       .reset_index().set_index(['Typical_days', 'Hours']),
+                                       by=['Regions', 'Layers'])
 
         end_uses = end_uses.reset_index()
         end_uses['Elements'] = 'END_USES'
@@ -1273,8 +1808,8 @@ class Esmc:
 
         # Get curtailment
         curt_t = self.esom.get_var('Curt')
-        curt = self.ta.from_td_to_year(ts_td=curt_t.reset_index().set_index(['Typical_days', 'Hours'])) \
-            .groupby(['Regions', 'Technologies']).sum()
+        curt = self.ta.year_total(ts_td=curt_t.reset_index().set_index(['Typical_days', 'Hours']),
+                                  by=['Regions', 'Technologies'])
         # Get tech with a c_p_t defined (by addding list of res_params and flatten list of res_mult_param)
         tech_cpt = list(self.data_indep['Misc_indep']['time_series_mapping']['res_params'].values()) \
                    + [element for sublist in
@@ -225,6 +225,58 @@ class OptiProbl:
         return param
 
 
+    def set_set(self, set_name: str, values):
+        """Assigns the members of a set of the optimisation problem, instead of reading them from a .dat file
+
+        Parameters
+        ----------
+        set_name: str
+        Name of the set. Should be written as in the .mod file
+        values: list or dict
+        Members of the set (tuples for sets of dimension > 1),
+        or dictionary with the members of each instance of an indexed set
+
+        """
+        ampl_set = self.ampl.getSet(set_name)
+        if isinstance(values, dict):
+            for k, v in values.items():
+                ampl_set[k] = v
+        else:
+            ampl_set.setValues(values)
+        return
+
+    def set_param(self, param_name: str, values):
+        """Assigns the values of a parameter of the optimisation problem, instead of reading them from a .dat file
+
+        Parameters
+        ----------
+        param_name: str
+        Name of the parameter. Should be written as in the .mod file
+        values: scalar or pd.Series
+        Value of a scalar parameter or values indexed by the indices of the parameter
+        (pd.MultiIndex for a parameter with several indices)
+
+        """
+        ampl_param = self.ampl.getParameter(param_name)
+        if isinstance(values, pd.Series):
+            ampl_param.setValues(values)
+        else:
+            ampl_param.set(values)
+        return
+
+    def set_params(self, df: pd.DataFrame):
+        """Assigns the values of several parameters of the optimisation problem indexed on the same sets,
+        as a table 'param : p1 p2 ... :=' of a .dat file does
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+        Values of the parameters, with the names of the parameters as columns and their indices as index
+
+        """
+        self.ampl.setData(DataFrame.fromPandas(df))
+        return
+
     def get_var(self, var_name:str):
         """Function to extract the mentioned variable and store it into self.outputs
 
@@ -1,4 +1,10 @@
 import logging
+import copy
+import json
+import os
+import threading
+import uuid
+from collections.abc import MutableMapping
 
 import pandas as pd
 import numpy as np
@@ -9,6 +15,179 @@ from esmc.utils.df_utils import clean_indices
 from esmc.common import CSV_SEPARATOR
 
 
+class RegionData(MutableMapping):
+    """Data of a region, read lazily and defined as overrides of the data of the reference region
+
+    Each table is read from the files of the region at its first access, by the loader registered
+    for it (see set_loader). Until then, the tables of the reference region are shared by all the regions,
+    each region only storing the values redefined in its own files (overrides), such that initializing
+    the regions does not copy the data of the reference region. A table is materialized
+    (full copy of the reference table updated with the overrides) at its first access through the mapping,
+    and then belongs to the region: it can be modified in place without affecting the reference region or the other regions.
+    The read-only accesses (e.g. concatenation of the regional data) use view instead, which does not materialize
+    the table, such that only the tables modified by a region are copied.
+    Setting a table replaces it for this region only.
+    The accesses are thread-safe: the first access to a table (reading, materialization) holds a lock of the instance.
+
+    Parameters
+    ----------
+    ref : dict
+        Data of the reference region (None for the reference region itself). The mapping is copied (not its tables)
+        such that replacing a table of the reference region afterwards does not affect this region.
+        In-place modifications of a reference table affect the regions that did not access it yet.
+        The tables of the reference region not read yet are taken from it at their first access by this region.
+
+    """
+
+    def __init__(self, ref=None):
+        if ref is None:
+            ref = dict()
+        if isinstance(ref, RegionData):
+            self.ref = dict(ref.own)
+            self.ref_lazy = {key: ref for key in ref if key not in ref.own}
+        else:
+            self.ref = dict(ref)
+            self.ref_lazy = dict()
+        self.loaders = dict()
+        self.overrides = dict()
+        self.own = dict()
+        # reentrant, as a loader can access other tables (e.g. Weights needs Time_series)
+        self.lock = threading.RLock()
+
+    def set_loader(self, key, load):
+        """Registers the function reading the table key of the region, called at the first access to the table
+
+        Parameters
+        ----------
+        key : str
+            Name of the table
+        load : callable
+            Function without argument setting the table (or its overrides) in this mapping
+
+        """
+        with self.lock:
+            self.loaders[key] = load
+
+    def override(self, key, value):
+        """Redefines some values of a table of the reference region for this region
+
+        Parameters
+        ----------
+        key : str
+            Name of the table
+        value : pd.DataFrame or dict
+            Values replacing the ones of the reference region (DataFrame.update or dict.update semantics)
+
+        """
+        with self.lock:
+            if key in self.own:
+                self.own[key].update(value)
+            elif key in self.overrides:
+                self.overrides[key] = [*self.overrides[key], value]
+            else:
+                self.overrides[key] = [value]
+
+    def prefetch(self):
+        """Reads all the tables of the region not read yet, without copying the tables of the reference region"""
+        with self.lock:
+            for key in list(self.loaders):
+                # a loader can read the tables it depends on (e.g. Weights needs Time_series)
+                if key in self.loaders:
+                    self.loaders.pop(key)()
+
+    def is_materialized(self, key):
+        """Whether the table key has already been read or copied from the reference region"""
+        return key in self.own
+
+    def view(self, key):
+        """Returns the table key without materializing it
+
+        If the table was not materialized yet, the table of the reference region is returned if the region
+        does not redefine any of its values, otherwise a copy updated with the overrides that is not kept by the region.
+        The result should only be read, as it can be the table of the reference region: the tables to modify
+        are accessed through the mapping (see __getitem__).
+
+        Parameters
+        ----------
+        key : str
+            Name of the table
+
+        """
+        try:
+            # already materialized, without taking the lock
+            return self.own[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key in self.loaders:
+                self.loaders.pop(key)()
+            if key in self.own:
+                return self.own[key]
+            return self.merge(key)
+
+    def merge(self, key):
+        """Returns the table key of the reference region updated with the overrides of the region
+
+        The table of the reference region is returned as such if the region does not redefine any of its values.
+        To be called holding the lock.
+
+        """
+        if key in self.ref_lazy:
+            self.ref[key] = self.ref_lazy.pop(key).view(key)
+        overrides = self.overrides.get(key, list())
+        if key in self.ref:
+            if not overrides:
+                return self.ref[key]
+            value = copy.deepcopy(self.ref[key]) if isinstance(self.ref[key], dict) else self.ref[key].copy()
+        elif overrides:
+            value = overrides[0].copy()
+        else:
+            raise KeyError(key)
+        for o in overrides:
+            value.update(o)
+        return value
+
+    def __getitem__(self, key):
+        try:
+            # already materialized, without taking the lock
+            return self.own[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key in self.loaders:
+                self.loaders.pop(key)()
+            if key not in self.own:
+                value = self.merge(key)
+                if value is self.ref.get(key):
+                    value = copy.deepcopy(value) if isinstance(value, dict) else value.copy()
+                self.overrides.pop(key, None)
+                self.own[key] = value
+            return self.own[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.loaders.pop(key, None)
+            self.overrides.pop(key, None)
+            self.own[key] = value
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            for d in [self.ref, self.ref_lazy, self.loaders, self.overrides, self.own]:
+                d.pop(key, None)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(dict.fromkeys([*self.ref, *self.ref_lazy, *self.loaders, *self.overrides, *self.own]))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, key):
+        return any(key in d for d in [self.own, self.loaders, self.ref, self.ref_lazy, self.overrides])
+
+
 class Region:
     """TODO update doc
 
@@ -20,21 +199,34 @@ class Region:
         nuts abbreviation of the region. If several regions merged together, '-' is used between the regions names
     data_dir : pathlib.Path
        path to the directory containing all the data
+    ts_cube : esmc.utils.ts_cube.TimeSeriesCube
+       if given, the time series are read-only float32 views of this memory-mapped cube instead of being read
+       from the csv file of the region
+    ref_data : dict
+       data of the reference region, only for the other regions. Their data attribute is then a RegionData
+       sharing the tables of the reference region and storing only the values redefined by the region.
+    lazy : bool
+       if True, each table of the data attribute is read from the files of the region at its first
+       access (e.g. analysis not needing the time series never reads them) and prefetch reads all of them.
+       If False (default), all the data are read at the initialization.
 
     """
 
-    def __init__(self, nuts, data_dir, ref_region=False):
+    def __init__(self, nuts, data_dir, ref_region=False, ts_cube=None, ref_data=None, lazy=False):
         # instantiate different attributes
         self.nuts = nuts
         self.ref_region = ref_region # whether it is the reference region or not
+        self.ts_cube = ts_cube
         #TODO add geographical management
         # self.name =
         # self.geo =
         self.data_path = data_dir/nuts
         #('DATA_'+nuts+'.xlsx')
         if ref_region:
-            self.data = dict()
-        self.read_data()
+            self.data = RegionData()
+        elif ref_data is not None:
+            self.data = RegionData(ref=ref_data)
+        self.read_data(lazy=lazy)
 
         self.n_daily_ts = pd.DataFrame() # normalized (sum over the year=1) daily time series (shape=(365x(24*n_ts))
         self.ts_td = None # rescaled daily time series of the typical days
@@ -51,12 +243,28 @@ class Region:
 
         """
         # The time series are redefined fully without considering the data of the ref_region
-        # read the csv
-        self.data['Time_series'] = pd.read_csv(self.data_path/'Time_series.csv', sep=CSV_SEPARATOR, header=[0], index_col=0)
-        self.data['Time_series'] = clean_indices(self.data['Time_series'])
-        self.data['Time_series'].set_index(np.arange(1, 8761), inplace=True) # setting index from 1 to 8760 hours
+        if self.ts_cube is not None:
+            self.data['Time_series'] = self.ts_cube.get(self.nuts)
+        else:
+            self.data['Time_series'] = self.read_csv_cached(
+                'Time_series', lambda: self.read_ts_csv(self.data_path/'Time_series.csv'))
         return
 
+    @staticmethod
+    def read_ts_csv(ts_path: Path):
+        """Reads and cleans a Time_series.csv file
+
+        Returns
+        -------
+        Time series dataframe (8760xN_ts) indexed from 1 to 8760
+
+        """
+        # read the csv
+        df = pd.read_csv(ts_path, sep=CSV_SEPARATOR, header=[0], index_col=0)
+        df = clean_indices(df)
+        df.set_index(np.arange(1, 8761), inplace=True) # setting index from 1 to 8760 hours
+        return df
+
     def read_weights(self):
         """Read the weights of the time series of this region and stores it in the data attribute as a dataframe
 
@@ -65,16 +273,77 @@ class Region:
 
         """
         # the Weights are redefined fully without considering the ref_region
-        self.data['Weights'] = pd.read_csv(self.data_path/'Weights.csv', sep=CSV_SEPARATOR, header=[0], index_col=[0])\
-            .dropna(axis=0, how='any')
-        self.data['Weights'].index.rename('Category', inplace=True)
-        self.data['Weights'] = clean_indices(self.data['Weights'])
+        def read():
+            df = pd.read_csv(self.data_path/'Weights.csv', sep=CSV_SEPARATOR, header=[0], index_col=[0])\
+                .dropna(axis=0, how='any')
+            df.index.rename('Category', inplace=True)
+            return clean_indices(df)
+
+        self.data['Weights'] = self.read_csv_cached('Weights', read)
 
         # The time series without weight into data have NaN as Weight
         self.data['Weights'] = self.data['Weights'].reindex(self.data['Time_series'].columns,
                                                             method=None, fill_value=np.nan)
         return
 
+    def read_csv_cached(self, name: str, read):
+        """Reads a numerical csv file of the region through a binary cache
+
+        The cleaned dataframe read from data_path/<name>.csv is cached into data_path/.cache as a .npy file
+        of its values and a json manifest of its labels. The cache is used as long as the modification time
+        and the size of the csv file are the ones stored in the manifest, otherwise it is rewritten.
+
+        Parameters
+        ----------
+        name : str
+            Name of the csv file (without extension)
+        read : callable
+            Function reading and cleaning the csv file, returning a dataframe of numbers
+
+        Returns
+        -------
+        Dataframe read from the cache or from the csv file
+
+        """
+        csv_path = self.data_path / (name + '.csv')
+        cache_dir = self.data_path / '.cache'
+        manifest_path = cache_dir / (name + '.json')
+        values_path = cache_dir / (name + '.npy')
+        stat = csv_path.stat()
+        source = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+        if manifest_path.is_file() and values_path.is_file():
+            with open(manifest_path, 'r') as fp:
+                manifest = json.load(fp)
+            values = np.load(values_path, allow_pickle=False) \
+                if manifest['source'] == source and 'dtypes' in manifest else None
+            # the values can be the ones of another manifest while another process rewrites the cache
+            if values is not None and values.shape == (len(manifest['index']), len(manifest['columns'])):
+                df = pd.DataFrame(values, index=pd.Index(manifest['index'], name=manifest['index_name']),
+                                  columns=manifest['columns'])
+                # restore the columns read as integers from the csv file
+                dtypes = dict(zip(manifest['columns'], manifest['dtypes']))
+                if any(t != 'float64' for t in dtypes.values()):
+                    df = df.astype(dtypes)
+                return df
+
+        df = read()
+        manifest = {'source': source, 'index': df.index.tolist(), 'index_name': df.index.name,
+                    'columns': df.columns.tolist(), 'dtypes': [str(t) for t in df.dtypes]}
+        try:
+            cache_dir.mkdir(exist_ok=True)
+            # write into temporary files, the manifest last, such that a partially written cache is never used
+            # (named uniquely, as several processes can read the same data directory)
+            tmp = name + '.' + uuid.uuid4().hex + '.tmp'
+            np.save(cache_dir / (tmp + '.npy'), df.values.astype(np.float64), allow_pickle=False)
+            os.replace(cache_dir / (tmp + '.npy'), values_path)
+            with open(cache_dir / (tmp + '.json'), 'w') as fp:
+                json.dump(manifest, fp)
+            os.replace(cache_dir / (tmp + '.json'), manifest_path)
+        except OSError as e:
+            logging.warning('Could not cache ' + str(csv_path) + ': ' + str(e))
+        return df
+
     def read_eud(self):
         """Read the End-uses demands of the region and stores it in the data attribute as a dataframe
 
@@ -107,8 +376,8 @@ class Region:
                 # read csv and clean df
                 df = pd.read_csv(r_path, sep=CSV_SEPARATOR, header=[0], index_col=[0]).dropna(axis=1, how='all')
                 df = clean_indices(df)
-                # using update method to replace only the data redefined in the csv of the region
-                self.data['Resources'].update(df)
+                # replace only the data redefined in the csv of the region
+                self.update_data('Resources', df)
 
         return
 
@@ -131,8 +400,8 @@ class Region:
             else:
                 df = pd.read_csv(r_path, sep=CSV_SEPARATOR, header=[0], index_col=[0]).dropna(how='all', axis=1)
                 df = clean_indices(df)
-                # using update method to replace only the data redefined in the csv of the region
-                self.data['Technologies'].update(df)
+                # replace only the data redefined in the csv of the region
+                self.update_data('Technologies', df)
         return
 
     def read_storage_power_to_energy(self):
@@ -150,8 +419,8 @@ class Region:
             if self.ref_region:
                 self.data['Storage_power_to_energy'] = df
             else:
-                # using update method to replace only the data redefined in the csv of the region
-                self.data['Storage_power_to_energy'].update(df)
+                # replace only the data redefined in the csv of the region
+                self.update_data('Storage_power_to_energy', df)
         return
 
     def read_misc(self):
@@ -166,25 +435,61 @@ class Region:
                  self.data['Misc'] = d
              else:
                  # if not ref_region replace edited values
-                for key, value in d.items():
-                    self.data['Misc'][key] = value
+                self.update_data('Misc', d)
 
         return
 
 
-    def read_data(self, all=True, ):
+    def update_data(self, key, value):
+        """Replaces the values of the table key of the reference region redefined by this region
+
+        Parameters
+        ----------
+        key : str
+            Name of the table in the data attribute
+        value : pd.DataFrame or dict
+            Values redefined by this region
+
+        """
+        if isinstance(self.data, RegionData):
+            # stored as an override, the table is only copied from the reference region when accessed
+            self.data.override(key, value)
+        else:
+            self.data[key].update(value)
+        return
+
+    def read_data(self, all=True, lazy=False):
         """
         Reads the data related to this region
+
+        Parameters
+        ----------
+        lazy : bool
+            If True, the tables are not read but their reading functions are registered in the data attribute
+            (RegionData), such that each table is read at its first access
         """
+        readers = {'Demands': (self.read_eud, 'Demands.csv'),
+                   'Resources': (self.read_resources, 'Resources.csv'),
+                   'Technologies': (self.read_tech, 'Technologies.csv'),
+                   'Storage_power_to_energy': (self.read_storage_power_to_energy, 'Storage_power_to_energy.csv'),
+                   'Time_series': (self.read_ts, 'Time_series.csv'),
+                   'Weights': (self.read_weights, 'Weights.csv'),
+                   'Misc': (self.read_misc, 'Misc.json')}
+        if lazy:
+            for key, (read, file_name) in readers.items():
+                if (self.data_path / file_name).is_file():
+                    self.data.set_loader(key, read)
+            return
+
         logging.info('Read data from '+str(self.data_path))
+        for read, file_name in readers.values():
+            read()
+        return
 
-        self.read_eud()
-        self.read_resources()
-        self.read_tech()
-        self.read_storage_power_to_energy()
-        self.read_ts()
-        self.read_weights()
-        self.read_misc()
+    def prefetch(self):
+        """Reads all the tables of the data attribute not read yet (e.g. before running the whole pipeline)"""
+        logging.info('Read data from '+str(self.data_path))
+        self.data.prefetch()
         return
 
     def compute_cell_w(self, time_series_mapping:dict):
@@ -226,9 +531,9 @@ class Region:
         #     tot_ts[t] = tot_ts[t]*self.data['Demands'].loc[l,:].sum(axis=1, numeric_only=True).sum(axis=0)
         # multiply the sum of the production time series
         # by the maximum potential (f_max in GW) of the corresponding technologies
-        tot_ts[prod_simple] = tot_ts[prod_simple] * self.data['Technologies'].loc[prod_simple,'f_max']
+        tot_ts[prod_simple] = tot_ts[prod_simple] * self.data.view('Technologies').loc[prod_simple,'f_max']
         for t,l in res_mult_params.items():
-            tot_ts[t] = tot_ts[t] * self.data['Technologies'].loc[l,'f_max'].sum()
+            tot_ts[t] = tot_ts[t] * self.data.view('Technologies').loc[l,'f_max'].sum()
 
         # Add Cell_w to the Weights data
         self.data['Weights'].loc[:,'Cell_w'] = tot_ts*self.data['Weights'].loc[:,'Weights']
@@ -271,14 +576,13 @@ class Region:
 
         """
         if ts is None:
-            ts = self.data['Time_series'].copy()
+            ts = self.data['Time_series']
 
-        ts_names = ts.columns
-        # adding columns for pivoting
-        ts['Days'] = np.repeat(np.arange(1,366), 24, axis=0)
-        ts['H_of_D'] = np.resize(np.arange(1,25), ts.shape[0])
-        # pivoting normalized time series (norm_ts) to get daily normalized time series (Ndaily_ts)
-        return ts.pivot(index='Days', columns='H_of_D', values=ts_names)
+        # the hourly data being ordered by day, the pivoting is a reshape (8760xN_ts) -> (365x24xN_ts)
+        # followed by a transposition to order the columns by time series and then by hour of the day
+        a = ts.values.reshape(365, 24, -1).transpose(0, 2, 1).reshape(365, -1)
+        columns = pd.MultiIndex.from_product([ts.columns, np.arange(1, 25)], names=[None, 'H_of_D'])
+        return pd.DataFrame(a, index=pd.Index(np.arange(1, 366), name='Days'), columns=columns)
 
     def n_pivot_ts(self, ts=None):
         """Normalize and pivot time series
@@ -293,7 +597,7 @@ class Region:
 
         """
         if ts is None:
-            ts = self.data['Time_series'].copy()
+            ts = self.data['Time_series']
 
         self.n_daily_ts = self.pivot_ts(ts=self.norm_ts(ts=ts))
 
@@ -306,30 +610,88 @@ class Region:
         is equal to the sum over the year of the original time series
 
         """
-        ts = self.data['Time_series'].copy()
-        tot_yr = ts.sum() # compute the total of each ts over the year
-        ts = self.pivot_ts(ts).transpose() # pivotting the ts in a daily format
-        ts_td = ts.loc[:,td_count['TD_of_days']] # selecting only the ts of TDs
-        # computing the total over the year by multiplying the total of each TD by the number of days it represents
-        tot_td = ts_td.groupby(level=0).sum().mul(td_count.set_index('TD_of_days').loc[:,'#days'],axis=1).sum(axis=1)
-        ts_td = ts_td.mul(tot_yr/tot_td,axis=0, level=0).fillna(value=1e-4) # rescaling the ts of the TDs to have the same total over the year
-        ts_td.columns = td_count['TD_number'] # set index to TD_number
-        self.ts_td = ts_td
+        ts = self.data['Time_series']
+        ts_td = self.rescale_td_array(ts.values, td_count=td_count)
+        self.ts_td = self.td_array_to_df(ts_td, ts_names=ts.columns, td_count=td_count)
         return
 
-    def compute_peak_sh_and_sc(self):
+    @staticmethod
+    def rescale_td_array(ts: np.ndarray, td_count: pd.DataFrame):
+        """Select and rescale the time series of the typical days for one or several regions at once
+
+        Parameters
+        ----------
+        ts : np.ndarray
+            Hourly time series of shape (..., 8760, N_ts), the leading dimensions being e.g. the regions
+        td_count : pd.DataFrame()
+            Typical days (TD_of_days) and number of days they represent (#days), ordered by TD_number
+
+        Returns
+        -------
+        ts_td : np.ndarray
+            Rescaled time series of the typical days of shape (..., N_ts, 24, Nbr_TD)
+
+        """
+        days = ts.reshape(ts.shape[:-2] + (365, 24, ts.shape[-1])) # daily view of the ts (..., 365, 24, N_ts)
+        ts_td = days[..., td_count['TD_of_days'].values - 1, :, :] # selecting only the ts of TDs
+        tot_yr = ts.sum(axis=-2) # compute the total of each ts over the year
+        # total of each TD with a compensated (Kahan) sum over the hours, as done by pandas groupby
+        tot_day = np.zeros(ts_td.shape[:-2] + ts_td.shape[-1:])
+        comp = np.zeros_like(tot_day)
+        for h in range(24):
+            y = ts_td[..., h, :] - comp
+            t = tot_day + y
+            comp = (t - tot_day) - y
+            tot_day = t
+        # computing the total over the year by multiplying the total of each TD by the number of days it represents
+        tot_td = np.ascontiguousarray(np.swapaxes(tot_day * td_count['#days'].values[:, None], -1, -2)).sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # rescaling the ts of the TDs to have the same total over the year
+            ts_td = ts_td * (tot_yr / tot_td)[..., None, None, :]
+        ts_td[np.isnan(ts_td)] = 1e-4
+        return np.swapaxes(ts_td, -3, -1) # (..., N_ts, 24, Nbr_TD)
+
+    @staticmethod
+    def td_array_to_df(ts_td: np.ndarray, ts_names, td_count: pd.DataFrame):
+        """Labels the (N_ts, 24, Nbr_TD) array of the rescaled time series of the typical days
+
+        Returns
+        -------
+        ts_td : pd.DataFrame()
+            Rescaled time series of the typical days with (ts, H_of_D) as index and TD_number as columns
+
+        """
+        index = pd.MultiIndex.from_product([ts_names, np.arange(1, 25)], names=[None, 'H_of_D'])
+        return pd.DataFrame(ts_td.reshape(-1, ts_td.shape[-1]), index=index,
+                            columns=pd.Index(td_count['TD_number'].values, name='TD_number'))
+
+    def compute_peak_sh_and_sc(self, period_duration=1):
         """Computes the peak_sh_factor
         Computes the ratio between the peak space heating demand over the year and over the typical days (peak_sh_factor)
         and stores it into the attribute
+
+        Parameters
+        ----------
+        period_duration : int
+            Number of hours aggregated into each period of the typical days.
+            The peak over the typical days is then the peak of the average demand over each period.
         """
         if self.ts_td is None:
             logging.error('Call first rescale_td_ts to compute td_ts')
+
+        def max_td(ts):
+            # peak over the typical days of the ts averaged over the periods
+            a = self.ts_td.loc[(ts, slice(None)), :].values
+            if period_duration != 1:
+                a = a.reshape(-1, period_duration, a.shape[-1]).mean(axis=1)
+            return a.max()
+
         # TODO this should be linked with the inputs for the names of the ts
-        max_sh_td = self.ts_td.loc[('HEAT_LOW_T_SH', slice(None)),:].max().max()
+        max_sh_td = max_td('HEAT_LOW_T_SH')
         max_sh_yr = self.data['Time_series'].loc[:,'HEAT_LOW_T_SH'].max()
         self.peak_sh_factor = max_sh_yr/max_sh_td
 
-        max_sc_td = self.ts_td.loc[('SPACE_COOLING', slice(None)), :].max().max()
+        max_sc_td = max_td('SPACE_COOLING')
         max_sc_yr = self.data['Time_series'].loc[:, 'SPACE_COOLING'].max()
         self.peak_sc_factor = max_sc_yr / max_sc_td
         return
@@ -343,7 +705,7 @@ class Region:
         Discount rate
         """
         # create a series i_rate with technologies names as index
-        tech = self.data['Technologies']
+        tech = self.data.view('Technologies')
         i_rate_s = pd.Series(i_rate, index=tech.index)
         tau = i_rate_s * (1 + i_rate_s) ** tech['lifetime'] / (((1 + i_rate_s) ** tech['lifetime']) - 1)
         self.data['tau'] = tau
@@ -0,0 +1,180 @@
+"""
+This file contains a class to share the time series of all the regions of a data directory between processes
+
+"""
+import logging
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from esmc.utils.region import Region
+
+
+class TimeSeriesCube:
+    """
+
+    The TimeSeriesCube class stores the time series of all the regions of a data directory (e.g. Data/2050)
+    into a single float32 array of shape (n_regions x n_ts x 8760) saved into data_dir/.cache/time_series_cube_<id>.npy.
+    The file is built once and memory-mapped read-only, such that all the processes running cases
+    on the same data directory share a single physical copy of the time series in the page cache.
+    The manifest data_dir/.cache/time_series_cube.json gives the file of the current cube, which is never overwritten:
+    a process opening the cube while another one rebuilds it gets either the previous or the new cube
+    with its own manifest. The cube is built by a single process at a time (see lock).
+
+    Parameters
+    ----------
+    data_dir : pathlib.Path
+       path to the directory containing the data of all the regions
+
+    """
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self.cube_path = None
+        self.manifest_path = data_dir / '.cache' / 'time_series_cube.json'
+        self.lock_path = data_dir / '.cache' / 'time_series_cube.lock'
+        self.cube = None
+        self.manifest = dict()
+        # (re)build the cube if any Time_series.csv changed since it was built
+        if not self.is_valid():
+            with self.lock():
+                # another process may have built it while waiting for the lock
+                if not self.is_valid():
+                    self.build()
+        self.open()
+        return
+
+    def __deepcopy__(self, memo):
+        # the cube is read-only and shared by all the regions
+        return self
+
+    def sources(self):
+        """Modification time and size of the Time_series.csv of each region of the data directory"""
+        sources = dict()
+        for d in sorted(self.data_dir.iterdir()):
+            ts_path = d / 'Time_series.csv'
+            if ts_path.is_file():
+                stat = ts_path.stat()
+                sources[d.name] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        return sources
+
+    def is_valid(self):
+        """Checks whether the cube exists and is up to date with the csv files"""
+        if not self.manifest_path.is_file():
+            return False
+        with open(self.manifest_path, 'r') as fp:
+            manifest = json.load(fp)
+        return (manifest.get('cube') is not None and (self.manifest_path.parent / manifest['cube']).is_file()
+                and manifest['sources'] == self.sources())
+
+    @contextmanager
+    def lock(self, timeout=600, poll=0.1):
+        """Lock file ensuring that a single process builds the cube at a time
+
+        Parameters
+        ----------
+        timeout : float
+            Age in seconds after which a lock file is considered as left by a crashed process and removed
+        poll : float
+            Time in seconds between two attempts to take the lock
+
+        """
+        self.lock_path.parent.mkdir(exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - self.lock_path.stat().st_mtime > timeout:
+                        logging.warning('Removing stale lock ' + str(self.lock_path))
+                        self.lock_path.unlink()
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(poll)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            self.lock_path.unlink()
+
+    def build(self):
+        """Reads the Time_series.csv of all the regions and writes them into a new cube file
+
+        The cube is written into a new file, named with a unique id, and is only used once the manifest
+        pointing to it replaced the previous one. The previous cube file is then removed (if not in use).
+
+        """
+        cube_path = self.manifest_path.parent / ('time_series_cube_' + uuid.uuid4().hex[:16] + '.npy')
+        logging.info('Building time series cube ' + str(cube_path))
+        sources = self.sources()
+        frames = {r: Region.read_ts_csv(self.data_dir / r / 'Time_series.csv') for r in sources}
+        columns = {r: df.columns.tolist() for r, df in frames.items()}
+        n_ts = max(len(c) for c in columns.values())
+
+        cube_path.parent.mkdir(exist_ok=True)
+        previous = None
+        if self.manifest_path.is_file():
+            with open(self.manifest_path, 'r') as fp:
+                previous = json.load(fp).get('cube')
+        # write the cube into its new file, then the manifest through a temporary file,
+        # such that a partially written cube is never used
+        cube = np.lib.format.open_memmap(cube_path, mode='w+', dtype=np.float32, shape=(len(frames), n_ts, 8760))
+        for i, df in enumerate(frames.values()):
+            cube[i, :df.shape[1], :] = df.values.T
+        cube.flush()
+        del cube
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.' + uuid.uuid4().hex + '.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump({'sources': sources, 'cube': cube_path.name, 'shape': [len(frames), n_ts, 8760],
+                       'regions': list(frames.keys()), 'columns': columns}, fp)
+        os.replace(tmp_path, self.manifest_path)
+        if previous is not None and previous != cube_path.name:
+            try:
+                (self.manifest_path.parent / previous).unlink()
+            except OSError:
+                # still memory-mapped by another process (on Windows) or already removed
+                pass
+        return
+
+    def open(self):
+        """Memory-maps the cube read-only and checks that it matches its manifest"""
+        for attempt in range(3):
+            with open(self.manifest_path, 'r') as fp:
+                self.manifest = json.load(fp)
+            self.cube_path = self.manifest_path.parent / self.manifest['cube']
+            try:
+                self.cube = np.load(self.cube_path, mmap_mode='r')
+                break
+            except FileNotFoundError:
+                # replaced by a rebuild in another process since the manifest was read
+                if attempt == 2:
+                    raise
+        if list(self.cube.shape) != self.manifest['shape']:
+            raise ValueError('The time series cube ' + str(self.cube_path) + ' has the shape ' + str(self.cube.shape)
+                             + ' instead of ' + str(self.manifest['shape']) + ' given by its manifest')
+        return
+
+    def get(self, region: str):
+        """Time series of a region
+
+        Parameters
+        ----------
+        region : str
+            Name of the directory of the region in data_dir
+
+        Returns
+        -------
+        Read-only dataframe (8760xN_ts) of float32 viewing the memory-mapped cube (no copy)
+
+        """
+        columns = self.manifest['columns'][region]
+        a = self.cube[self.manifest['regions'].index(region), :len(columns), :]
+        return pd.DataFrame(a.T, index=np.arange(1, 8761), columns=columns, copy=False)
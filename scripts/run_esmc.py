@@ -55,6 +55,7 @@ for c in cases:
               'year': 2050}
 
     # initialize EnergyScope Multi-cells framework
+    # (add period_duration=2, 3, 4 or 6 to aggregate the hours of the typical days for faster screening runs)
     my_model = Esmc(config, nbr_td=tds)
 
     # read the indep data
@@ -66,18 +67,14 @@ for c in cases:
     # update some data
     ft_to_drop = ['BIOMASS_TO_GASOLINE', 'BIOMASS_TO_DIESEL', 'BIOWASTE_TO_GASOLINE', 'BIOWASTE_TO_DIESEL',
                   'POWER_TO_GASOLINE', 'POWER_TO_DIESEL', 'H2_TO_GASOLINE', 'H2_TO_DIESEL']
-    my_model.ref_region.data['Technologies'] = my_model.ref_region.data['Technologies'].drop(index=ft_to_drop)
+    # drop FT GASOLINE and FT DIESEL for clarity (in all the regions and the reference region)
+    my_model.drop_data('Technologies', ft_to_drop)
     my_model.data_indep['Layers_in_out'] = my_model.data_indep['Layers_in_out'].drop(index=ft_to_drop)
-    # force to be 100% renewable
-    for r_code, region in my_model.regions.items():
-        # fossil-free
-        region.data['Resources'].loc[no_imports, 'avail_exterior'] = 0
-        # nuclear free
-        region.data['Technologies'].loc['NUCLEAR', 'f_min'] = 0
-        region.data['Technologies'].loc['NUCLEAR', 'f_max'] = 0
-
-        # drop FT GASOLINE and FT DIESEL for clarity
-        region.data['Technologies'] = region.data['Technologies'].drop(index=ft_to_drop)
+    # force to be 100% renewable (the changed values are logged into my_model.data_changes)
+    # fossil-free
+    my_model.update_data('Resources', 0, index=no_imports, columns='avail_exterior')
+    # nuclear free
+    my_model.update_data('Technologies', 0, index='NUCLEAR', columns=['f_min', 'f_max'])
 
     # according to scenario change some inputs
     if c.startswith('low_demand'):
@@ -85,21 +82,19 @@ for c in cases:
         # read low demand
         ld_all = pd.read_csv(my_model.project_dir / 'Data' / 'exogenous_data' / 'regions' / 'Low_demands_2050.csv',
                              header=0, index_col=[0, 1], sep=CSV_SEPARATOR) * 1000
-        for r_code, region in my_model.regions.items():
-            # update demand in each region
-            region.data['Demands'].update(ld_all.loc[(r_code, slice(None)), :].droplevel(level=0, axis=0))
-            # no short haul flights
-            region.data['Misc']['share_short_haul_flights_min'] = 0
-            region.data['Misc']['share_short_haul_flights_max'] = 1e-4
+        # update demand in each region
+        my_model.update_data('Demands', ld_all)
+        # no short haul flights
+        my_model.update_data('Misc', 0, columns='share_short_haul_flights_min')
+        my_model.update_data('Misc', 1e-4, columns='share_short_haul_flights_max')
     elif c.startswith('nuc'):
         obj = costs_opt['nuc']
         # read nuclear projections
         nuc_all = pd.read_csv(my_model.project_dir / 'Data' / 'exogenous_data' / 'regions' / 'nuclear_2050.csv',
                               header=0, index_col=0, sep=CSV_SEPARATOR)
-        for r_code, region in my_model.regions.items():
-            # force to install nuclear
-            region.data['Technologies'].loc['NUCLEAR_SMR', 'f_min'] = nuc_all.loc[r_code, 'Nuclear']
-            region.data['Technologies'].loc['NUCLEAR_SMR', 'f_max'] = nuc_all.loc[r_code, 'Nuclear'] + 1e-4
+        # force to install nuclear
+        my_model.update_data('Technologies', nuc_all['Nuclear'], index='NUCLEAR_SMR', columns='f_min')
+        my_model.update_data('Technologies', nuc_all['Nuclear'] + 1e-4, index='NUCLEAR_SMR', columns='f_max')
     else:
         obj = costs_opt['ref']
 
@@ -123,25 +118,28 @@ for c in cases:
                     my_model.cs_dir / 'epsilon_models' / 'epsilon_elec_grid.mod']
 
     # Initialize and solve the temporal aggregation algorithm:
-    # if already run, set algo='read' to read the solution of the clustering
-    # else, set algo='kmedoid' to run kmedoid clustering algorithm to choose typical days (TDs)
-    if i==0:
-        my_model.init_ta(algo='kmedoid', ampl_path=ampl_path)
-    else:
-        my_model.init_ta(algo='read', ampl_path=ampl_path)
+    # algo='kmedoid' to run kmedoid clustering algorithm to choose typical days (TDs)
+    # or algo='pam' to run the k-medoids clustering in python (no solver needed)
+    # or algo='ward' (or 'medoid_linkage') to cut a hierarchical clustering of the days
+    # add target_tse=0.22 to select the smallest number of TDs with a time series error below 0.22
+    # the clustering is only run if its inputs changed since the last run, otherwise it is read from the cache
+    my_model.init_ta(algo='kmedoid', ampl_path=ampl_path)
 
     # Print the time related data of the energy system optimization model using the TDs to represent it
-    my_model.print_td_data()
+    # wait=False to print it while printing the other data
+    my_model.print_td_data(wait=False)
 
-    # Print data
+    # Print data (the .dat files are printed concurrently and print_data waits for all of them)
     my_model.print_data(indep=True)
 
     # Set the Energy System Optimization Model (ESOM) as an ampl formulated problem
+    # its data are assigned directly from memory (the printed .dat files are kept for archiving),
+    # use dat_files=True to read them from the printed .dat files instead
     if 'epsilon' in c:
         mod_path[1].parent.mkdir(parents=True, exist_ok=True)
-        my_model.set_esom(ampl_path=ampl_path, mod_path=mod_path)
+        my_model.set_esom(ampl_path=ampl_path, mod_path=mod_path, dat_files=False)
     else:
-        my_model.set_esom(ampl_path=ampl_path)
+        my_model.set_esom(ampl_path=ampl_path, dat_files=False)
 
     # Solving the ESOM
     my_model.solve_esom()
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 from pathlib import Path
 
 # additional line for VS studio
@@ -47,8 +48,7 @@ for red in reduction:
     my_model.init_ta(algo='read', ampl_path=ampl_path)
 
     # Update data for gwp_limit
-    for r,g in co2_1990.items():
-        my_model.regions[r].data['Misc']['gwp_limit'] = g*(1-red)
+    my_model.update_data('Misc', pd.Series(co2_1990) * (1 - red), columns='gwp_limit')
 
     # Print the time related data of the energy system optimization model using the TDs to represent it
     my_model.print_td_data()